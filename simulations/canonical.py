@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from enum import Enum
+from itertools import count
+from typing import Tuple
+from uuid import UUID
+import hashlib
+import pickle
+import struct
+
+from myrepr import ReprObject
+
+# Deterministic binary encoding of protocol objects used for signing, hashing and PoW.
+# Every value is a one byte tag followed by its payload, containers and objects are
+# length prefixed and unordered containers are sorted by the encoding of their items.
+
+# stamps of CanonicalObject assignments, never reused so a stamp identifies one state of an object
+_VERSIONS = count()
+
+
+def _length(n: int) -> bytes:
+    return struct.pack(">I", n)
+
+
+def _sized(tag: bytes, data: bytes) -> bytes:
+    return tag + _length(len(data)) + data
+
+
+def _encode_fields(class_name: str, fields) -> bytes:
+    items = sorted((_encode_str(k), encode(v)) for k, v in fields)
+    return b"O" + _encode_str(class_name) + _length(len(items)) + b"".join(k + v for k, v in items)
+
+
+def _encode_str(v: str) -> bytes:
+    return _sized(b"S", v.encode("utf-8"))
+
+
+def _object_fields(obj, exclude: Tuple[str] = ()):
+    return [(k, v) for k, v in vars(obj).items()
+            if not k.startswith("_canonical") and k not in exclude and not callable(v)]
+
+
+def _canonical_children(v):
+    if isinstance(v, CanonicalObject):
+        yield v
+    elif isinstance(v, (tuple, list, set, frozenset)):
+        for item in v:
+            yield from _canonical_children(item)
+    elif isinstance(v, dict):
+        for item in v.items():
+            yield from _canonical_children(item)
+
+
+def encode(obj) -> bytes:
+    if obj is None:
+        return b"N"
+    if obj is True:
+        return b"T"
+    if obj is False:
+        return b"F"
+    if isinstance(obj, CanonicalObject):
+        return obj.canonical_bytes()
+    if isinstance(obj, Enum):
+        return b"K" + _encode_str(obj.__class__.__name__) + encode(obj.value)
+    if isinstance(obj, int):
+        return _sized(b"I", obj.to_bytes((obj.bit_length()+8)//8, "big", signed=True))
+    if isinstance(obj, str):
+        return _encode_str(obj)
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return _sized(b"B", bytes(obj))
+    if isinstance(obj, float):
+        return b"D" + struct.pack(">d", obj)
+    if isinstance(obj, datetime):
+        return _sized(b"W", obj.isoformat().encode("ascii"))
+    if isinstance(obj, timedelta):
+        return b"L" + struct.pack(">iiI", obj.days, obj.seconds, obj.microseconds)
+    if isinstance(obj, UUID):
+        return b"U" + obj.bytes
+    if isinstance(obj, tuple):
+        return b"P" + _length(len(obj)) + b"".join(encode(v) for v in obj)
+    if isinstance(obj, list):
+        return b"A" + _length(len(obj)) + b"".join(encode(v) for v in obj)
+    if isinstance(obj, (set, frozenset)):
+        return b"E" + _length(len(obj)) + b"".join(sorted(encode(v) for v in obj))
+    if isinstance(obj, dict):
+        items = sorted((encode(k), encode(v)) for k, v in obj.items())
+        return b"M" + _length(len(items)) + b"".join(k + v for k, v in items)
+    if isinstance(obj, ReprObject):
+        return _encode_fields(obj.__class__.__name__, _object_fields(obj))
+    return _sized(b"X", pickle.dumps(obj))
+
+
+def signing_bytes(obj) -> bytes:
+    if isinstance(obj, CanonicalObject):
+        return obj.signing_bytes()
+    return encode(obj)
+
+
+def digest(obj) -> bytes:
+    if isinstance(obj, CanonicalObject):
+        return obj.canonical_digest()
+    return hashlib.sha256(encode(obj)).digest()
+
+
+class CanonicalObject(ReprObject):
+    """ReprObject with a memoized canonical encoding.
+
+    The encoding is dropped whenever an attribute is assigned and is rebuilt lazily. Fields
+    listed in `_canonical_exclude` (e.g. the signature) are left out of `signing_bytes` and
+    appended after it in the full encoding, so assigning them keeps the own memo valid. Every
+    assignment, excluded fields included, stamps the object with a new version; a parent keeps
+    the versions of the nested canonical objects it encoded, so a change anywhere below it is
+    noticed as well. Lists, dicts and sets are refused as field values since changing them in
+    place would go unnoticed; other mutable values (e.g. plain ReprObjects) must not be changed
+    in place once the object has been encoded.
+    """
+    _canonical_exclude: Tuple[str] = ()
+
+    def __setattr__(self, name, value) -> None:
+        if not name.startswith("_canonical"):
+            if isinstance(value, (list, dict, set, bytearray)):
+                raise TypeError(f"{self.__class__.__name__}.{name}: mutable {type(value).__name__} "
+                                "cannot be a canonical field, use a tuple, frozenset or bytes")
+            object.__setattr__(self, "_canonical_version", next(_VERSIONS))
+            if name not in self._canonical_exclude:
+                object.__setattr__(self, "_canonical", None)
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        return {k: v for k, v in vars(self).items() if not k.startswith("_canonical")}
+
+    def _canonical_is_fresh(self, memo) -> bool:
+        for child, version in memo[1]:
+            if getattr(child, "_canonical_version", None) != version:
+                return False
+            child_memo = getattr(child, "_canonical", None)
+            if child_memo is None or not child._canonical_is_fresh(child_memo):
+                return False
+        return True
+
+    def signing_bytes(self) -> bytes:
+        memo = getattr(self, "_canonical", None)
+        if memo is None or not self._canonical_is_fresh(memo):
+            fields = _object_fields(self, self._canonical_exclude)
+            data = _encode_fields(self.__class__.__name__, fields)
+            # encoding the fields has left a fresh memo on every child
+            children = [(child, getattr(child, "_canonical_version", None))
+                        for _, v in fields for child in _canonical_children(v)]
+            memo = (data, children)
+            object.__setattr__(self, "_canonical", memo)
+        return memo[0]
+
+    def canonical_bytes(self) -> bytes:
+        data = self.signing_bytes()
+        if not self._canonical_exclude:
+            return data
+        return data + b"".join(encode(getattr(self, k, None)) for k in self._canonical_exclude)
+
+    def canonical_digest(self) -> bytes:
+        # SHA-256 of canonical_bytes, kept until the encoding or one of the excluded fields changes
+        data = self.signing_bytes()
+        version = getattr(self, "_canonical_version", None)
+        memo = getattr(self, "_canonical_digest", None)
+        if memo is None or memo[0] is not data or memo[1] != version:
+            memo = (data, version, hashlib.sha256(self.canonical_bytes()).digest())
+            object.__setattr__(self, "_canonical_digest", memo)
+        return memo[2]
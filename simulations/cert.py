@@ -1,68 +1,255 @@
 from __future__ import annotations
 
-from typing import Tuple, Dict
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, Optional, Tuple, Dict
+import os
 
 import crypto
 from myrepr import ReprObject
+from canonical import CanonicalObject
+from revocation import RevocationDelta, RevocationSnapshot, RevocationStore, RevocationView
 from datetime import datetime
 
-CA_BY_NAME: Dict[str, CertificationAuthority] = dict()
+MAX_CERTIFICATE_CHAIN_LENGTH = 8
+# below this many requests issue_certificates signs in-process
+BULK_ISSUE_MIN_PARALLEL = 16
 
+# (public_key, name, value, not_valid_after, not_valid_before) as taken by issue_certificate
+CertificateRequest = Tuple[bytes, str, Any, datetime, datetime]
+
+# (certificate fingerprint, CA key fingerprint) of the certificates whose signature has been
+# checked against that CA key, with their not_valid_after
+VERIFIED_CERTIFICATE_CACHE_SIZE = 100000
+VERIFIED_CERTIFICATES: OrderedDict[Tuple[bytes, bytes], datetime] = OrderedDict()
+
+
+class Certificate(CanonicalObject):
+    _canonical_exclude = ("signature",)
+    # certificates pickled before the field existed are not CA certificates
+    is_ca = False
 
-class Certificate(ReprObject):
     def __init__(self, ca_name: str, public_key: bytes,
                  name: str,
                  value,
                  not_valid_after: datetime,
-                 not_valid_before: datetime, signature) -> None:
+                 not_valid_before: datetime, signature: bytes = None,
+                 is_ca: bool = False) -> None:
         self.ca_name = ca_name
         self.public_key = public_key
         self.name = name
         self.value = value
         self.not_valid_after = not_valid_after
         self.not_valid_before = not_valid_before
+        self.is_ca = is_ca
         self.signature = signature
 
-    def verify(self):
-        if self.not_valid_after >= datetime.now() and self.not_valid_before <= datetime.now():
-            ca = get_certification_authority_by_name(self.ca_name)
-            if not ca is None:
-                if not ca.is_revoked(self):
-                    obj = (self.ca_name, self.public_key, self.name, self.value,
-                           self.not_valid_after, self.not_valid_before)
-                    return crypto.verify_object(obj, self.signature, ca.ca_public_key)
-        return False
+    def fingerprint(self) -> bytes:
+        # SHA-256 of the encoding with the signature; it does not say which CA key the signature
+        # was checked against, the verified-certificate cache pairs it with that key
+        return self.canonical_digest()
+
+    def verification_items(self, trust_store: TrustStore = None) -> Optional[List[Tuple[Certificate, bytes, bytes]]]:
+        trust_store = TRUST_STORE if trust_store is None else trust_store
+        return trust_store.verification_items(self)
+
+    def verify(self, trust_store: TrustStore = None):
+        items = self.verification_items(trust_store)
+        if items is None:
+            return False
+        for item in items:
+            if not crypto.verify_object(*item):
+                return False
+        for certificate, _, ca_public_key in items:
+            remember_verified_certificate(certificate, ca_public_key)
+        return True
+
+
+class TrustedAuthority(ReprObject):
+    def __init__(self, ca_name: str, ca_public_key: bytes, revocations: RevocationView = None) -> None:
+        self.ca_name = ca_name
+        self.ca_public_key = ca_public_key
+        self.revocations = revocations
+
+    def is_revoked(self, certificate: Certificate) -> bool:
+        if self.revocations is None:
+            return False
+        return self.revocations.is_revoked(certificate.fingerprint())
+
+
+class TrustStore:
+    """The CAs a node trusts.
+
+    Root authorities are trusted directly. An intermediate authority is trusted through a CA
+    certificate (is_ca set, name = intermediate CA name, public_key = its CA key) issued by
+    another trusted authority, chains are followed up to MAX_CERTIFICATE_CHAIN_LENGTH links. Every link that has
+    been verified lands in the verified-certificate cache, so it is checked only once.
+    """
+
+    def __init__(self) -> None:
+        self._authority_by_name: Dict[str, TrustedAuthority] = dict()
+        self._authority_by_key_fingerprint: Dict[bytes, TrustedAuthority] = dict()
+        self._intermediate_certificates: Dict[str, Certificate] = dict()
+
+    def _forget_key(self, authority) -> None:
+        fingerprint = key_fingerprint(authority.ca_public_key)
+        if self._authority_by_key_fingerprint.get(fingerprint) is authority:
+            del self._authority_by_key_fingerprint[fingerprint]
+
+    def _add(self, authority) -> None:
+        # an authority added again under its name may come with a new key, the old one is no longer trusted
+        previous = self._authority_by_name.get(authority.ca_name)
+        if previous is not None:
+            self._forget_key(previous)
+        self._authority_by_name[authority.ca_name] = authority
+        self._authority_by_key_fingerprint[key_fingerprint(authority.ca_public_key)] = authority
+
+    def add_root(self, authority) -> None:
+        self._intermediate_certificates.pop(authority.ca_name, None)
+        self._add(authority)
+
+    def add_intermediate(self, authority, certificate: Certificate) -> None:
+        if certificate.name != authority.ca_name or certificate.public_key != authority.ca_public_key:
+            raise ValueError("certificate does not certify this authority")
+        if not certificate.is_ca:
+            raise ValueError("certificate is not a CA certificate")
+        self._intermediate_certificates[authority.ca_name] = certificate
+        self._add(authority)
+
+    def remove(self, ca_name: str) -> None:
+        authority = self._authority_by_name.pop(ca_name, None)
+        if authority is not None:
+            self._forget_key(authority)
+        self._intermediate_certificates.pop(ca_name, None)
+
+    def get_authority_by_name(self, ca_name: str):
+        if ca_name in self._authority_by_name:
+            return self._authority_by_name[ca_name]
+        return None
+
+    def get_authority_by_key_fingerprint(self, fingerprint: bytes):
+        if fingerprint in self._authority_by_key_fingerprint:
+            return self._authority_by_key_fingerprint[fingerprint]
+        return None
+
+    def verification_items(self, certificate: Certificate) -> Optional[List[Tuple[Certificate, bytes, bytes]]]:
+        # None when the certificate or a link of its chain is not valid, otherwise the
+        # (certificate, signature, ca_public_key) items of the links not verified before
+        items = list()
+        for _ in range(MAX_CERTIFICATE_CHAIN_LENGTH):
+            if not (certificate.not_valid_before <= datetime.now() <= certificate.not_valid_after):
+                return None
+            ca = self.get_authority_by_name(certificate.ca_name)
+            if ca is None or ca.is_revoked(certificate):
+                return None
+            if not is_verified_certificate(certificate, ca.ca_public_key):
+                items.append((certificate, certificate.signature, ca.ca_public_key))
+            if certificate.ca_name not in self._intermediate_certificates:
+                return items
+            certificate = self._intermediate_certificates[certificate.ca_name]
+            if not certificate.is_ca:
+                return None
+        return None
+
+
+TRUST_STORE = TrustStore()
 
 
 class CertificationAuthority(ReprObject):
-    def __init__(self, ca_name: str, ca_private_key: bytes, ca_public_key: bytes) -> None:
-        global CA_BY_NAME
+    def __init__(self, ca_name: str, ca_private_key: bytes, ca_public_key: bytes, trust_store: TrustStore = TRUST_STORE) -> None:
         self.ca_name = ca_name
         self._ca_private_key = ca_private_key
         self.ca_public_key = ca_public_key
-        CA_BY_NAME[ca_name] = self
+        self.revocations = RevocationStore(ca_name)
+        if trust_store is not None:
+            trust_store.add_root(self)
 
     def issue_certificate(self, public_key: bytes,
                           name: str,
                           value,
                           not_valid_after: datetime,
-                          not_valid_before: datetime) -> Certificate:
-        obj = (self.ca_name, public_key, name, value,
-               not_valid_after, not_valid_before)
-        signature = crypto.sign_object(obj, self._ca_private_key)
-        return Certificate(self.ca_name, public_key, name, value, not_valid_after, not_valid_before, signature)
+                          not_valid_before: datetime,
+                          is_ca: bool = False) -> Certificate:
+        certificate = Certificate(self.ca_name, public_key, name, value, not_valid_after, not_valid_before, is_ca=is_ca)
+        certificate.signature = crypto.sign_object(certificate, self._ca_private_key)
+        return certificate
+
+    def issue_certificates(self, requests: List[CertificateRequest], max_workers: int = None) -> List[Certificate]:
+        certificates = [Certificate(self.ca_name, *request) for request in requests]
+        workers = max_workers or os.cpu_count() or 1
+        if len(certificates) < BULK_ISSUE_MIN_PARALLEL or workers < 2:
+            signatures = _sign_certificates(self._ca_private_key, certificates)
+        else:
+            chunk_size = max(1, len(certificates)//(4*workers))
+            chunks = [certificates[i:i+chunk_size] for i in range(0, len(certificates), chunk_size)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                signatures = [signature
+                              for chunk_signatures in executor.map(_sign_certificates, [self._ca_private_key]*len(chunks), chunks)
+                              for signature in chunk_signatures]
+        for certificate, signature in zip(certificates, signatures):
+            certificate.signature = signature
+        return certificates
+
+    def issue_intermediate_certificate(self, authority: CertificationAuthority,
+                                       not_valid_after: datetime,
+                                       not_valid_before: datetime) -> Certificate:
+        return self.issue_certificate(authority.ca_public_key, authority.ca_name, "ca", not_valid_after, not_valid_before,
+                                      is_ca=True)
+
+    def revoke_certificate(self, certificate: Certificate) -> None:
+        self.revocations.revoke(certificate.fingerprint())
+        forget_verified_certificate(certificate, self.ca_public_key)
 
     def is_revoked(self, certificate: Certificate) -> bool:
+        return self.revocations.is_revoked(certificate.fingerprint())
+
+    def revocation_snapshot(self) -> RevocationSnapshot:
+        return self.revocations.snapshot()
+
+    def revocation_delta(self, since_version: int) -> RevocationDelta:
+        return self.revocations.delta_since(since_version)
+
+
+def _sign_certificates(ca_private_key: bytes, certificates: List[Certificate]) -> List[bytes]:
+    return [crypto.sign_object(certificate, ca_private_key) for certificate in certificates]
+
+
+def create_certification_authority(ca_name: str, crypto_suite: str = crypto.DEFAULT_CRYPTO_SUITE, trust_store: TrustStore = TRUST_STORE) -> CertificationAuthority:
+    ca_private_key, ca_public_key = crypto.generate_asymetric_keys(crypto_suite)
+    return CertificationAuthority(ca_name, ca_private_key, ca_public_key, trust_store)
+
+
+def key_fingerprint(public_key: bytes) -> bytes:
+    return crypto.compute_sha256([public_key])
+
+
+def _verified_certificate_key(certificate: Certificate, ca_public_key: bytes) -> Tuple[bytes, bytes]:
+    return certificate.fingerprint(), key_fingerprint(ca_public_key)
+
+
+def is_verified_certificate(certificate: Certificate, ca_public_key: bytes) -> bool:
+    global VERIFIED_CERTIFICATES
+    key = _verified_certificate_key(certificate, ca_public_key)
+    if not key in VERIFIED_CERTIFICATES:
+        return False
+    if VERIFIED_CERTIFICATES[key] < datetime.now():
+        del VERIFIED_CERTIFICATES[key]
         return False
+    VERIFIED_CERTIFICATES.move_to_end(key)
+    return True
+
+
+def remember_verified_certificate(certificate: Certificate, ca_public_key: bytes) -> None:
+    global VERIFIED_CERTIFICATES
+    VERIFIED_CERTIFICATES[_verified_certificate_key(certificate, ca_public_key)] = certificate.not_valid_after
+    while len(VERIFIED_CERTIFICATES) > VERIFIED_CERTIFICATE_CACHE_SIZE:
+        VERIFIED_CERTIFICATES.popitem(last=False)
 
 
-def create_certification_authority(ca_name: str) -> CertificationAuthority:
-    ca_private_key, ca_public_key = crypto.generate_asymetric_keys()
-    return CertificationAuthority(ca_name, ca_private_key, ca_public_key)
+def forget_verified_certificate(certificate: Certificate, ca_public_key: bytes) -> None:
+    global VERIFIED_CERTIFICATES
+    VERIFIED_CERTIFICATES.pop(_verified_certificate_key(certificate, ca_public_key), None)
 
 
 def get_certification_authority_by_name(ca_name: str) -> CertificationAuthority:
-    global CA_BY_NAME
-    if ca_name in CA_BY_NAME:
-        return CA_BY_NAME[ca_name]
-    return None
+    return TRUST_STORE.get_authority_by_name(ca_name)
@@ -6,13 +6,18 @@ from experiment_tools import FOLDNAME, RUN_START
 from myrepr import ReprObject
 
 from stopwatch import Stopwatch
+from timeit import default_timer as timer
 from datetime import datetime, timedelta
-from cert import CertificationAuthority, create_certification_authority
+from cert import CertificationAuthority
 import crypto
+from keystore import KeyStore, keystore_path
+from liquidity import LiquidityNetwork
 from payments import PaymentChannel
+from peer_selection import PeerSelectionStrategy
+from subscriptions import Subscription, SubscriptionIndex
 
 from uuid import uuid4
-from sweetgossip import SweetGossipNode, RequestPayload, AbstractTopic, Settler
+from sweetgossip import SweetGossipNode, RequestPayload, AbstractTopic, Settler, propagate_subscription_summaries
 from functools import partial
 import simpy
 import itertools
@@ -24,6 +29,15 @@ import pygeohash as pgh
 # %%
 
 PAYANDREAD_TIME = time_to_int(2, 8, 0)
+CRYPTO_SUITE = crypto.DEFAULT_CRYPTO_SUITE
+KEYSTORE_DIR = "keystore"
+CHANNEL_BALANCE = 10_000
+CHANNEL_CAPACITY = 100_000
+GRID_ORIGIN = (42.6, -5.6)
+GRID_SPACING = 0.01
+# gig workers serve the geohash cell of this precision around them
+WORKER_AREA_PRECISION = 4
+WORKER_AVAILABILITY = timedelta(days=1)
 
 
 class GridNodeType(Enum):
@@ -41,19 +55,31 @@ class TaxiTopic(AbstractTopic):
 
 
 class GridNode(SweetGossipNode):
-    def __init__(self, name,  ca: CertificationAuthority, price_amount_for_routing, settler: Settler):
+    def __init__(self, name,  ca: CertificationAuthority, price_amount_for_routing, settler: Settler, keystore: KeyStore,
+                 liquidity_network: LiquidityNetwork, geohash: str = None, peer_selection: PeerSelectionStrategy = None,
+                 worker_subscriptions: SubscriptionIndex = None):
         self.grid_node_type = GridNodeType.Gossiper
-        private_key, public_key = crypto.generate_asymetric_keys()
-        certificate = ca.issue_certificate(public_key, "is_ok", True, not_valid_after=datetime.now(
-        )+timedelta(days=7), not_valid_before=datetime.now()-timedelta(days=7))
-        payment_channel = PaymentChannel()
+        self.geohash = geohash
+        self.worker_subscriptions = worker_subscriptions
+        private_key, public_key = keystore.get_keys(name)
+        certificate = keystore.get_certificate(name, ca, lambda: ca.issue_certificate(public_key, "is_ok", True, not_valid_after=datetime.now(
+        )+timedelta(days=7), not_valid_before=datetime.now()-timedelta(days=7)))
+        payment_channel = PaymentChannel(liquidity_network=liquidity_network,
+                                         node_id=liquidity_network.add_node(name, CHANNEL_BALANCE, CHANNEL_CAPACITY))
         super().__init__(name, certificate, private_key, payment_channel, price_amount_for_routing,
                          broadcast_conditions_timeout=timedelta(days=7), broadcast_conditions_pow_scheme="sha256", broadcast_conditions_pow_complexity=0, invoice_payment_timeout=timedelta(days=1),
                          timestamp_tolerance=timedelta(seconds=10),
-                         settler=settler)
+                         settler=settler,
+                         peer_selection=peer_selection)
 
     def set_grid_node_type(self, grid_node_type: GridNodeType):
         self.grid_node_type = grid_node_type
+        if grid_node_type == GridNodeType.GigWorker:
+            subscription = Subscription(self.name, self.geohash[:WORKER_AREA_PRECISION],
+                                        datetime.now(), datetime.now()+WORKER_AVAILABILITY)
+            self.subscriptions.subscribe(subscription)
+            if self.worker_subscriptions is not None:
+                self.worker_subscriptions.subscribe(subscription)
 
     def accept_topic(self, topic: AbstractTopic) -> bool:
         if isinstance(topic, TaxiTopic):
@@ -61,7 +87,7 @@ class GridNode(SweetGossipNode):
         return False
 
     def accept_broadcast(self, signed_topic: RequestPayload) -> Tuple[bytes, int]:
-        if self.grid_node_type == GridNodeType.GigWorker:
+        if self.grid_node_type == GridNodeType.GigWorker and self.subscriptions.match(signed_topic.topic):
             return bytes(f"mynameis={self.name}", encoding="utf8"), 4321
         else:
             return None, 0
@@ -88,12 +114,11 @@ class GridNode(SweetGossipNode):
             from_gh = pgh.encode(latitude=42.6, longitude=-5.6, precision=7)
             to_gh = pgh.encode(latitude=42.5, longitude=-5.7, precision=7)
             self.topic_id = uuid4()
-            topic = RequestPayload(self.topic_id,
-                                   TaxiTopic(from_geohash=from_gh,
-                                             to_geohash=to_gh,
-                                             pickup_after=datetime.now(),
-                                             dropoff_before=datetime.now() + timedelta(minutes=20)),
-                                   self.certificate)
+            self.topic = TaxiTopic(from_geohash=from_gh,
+                                   to_geohash=to_gh,
+                                   pickup_after=datetime.now(),
+                                   dropoff_before=datetime.now() + timedelta(minutes=20))
+            topic = RequestPayload(self.topic_id, self.topic, self.certificate)
             topic.sign(self._private_key)
             self.broadcast(e, topic)
             return None,
@@ -108,6 +133,8 @@ class GridNode(SweetGossipNode):
 
             responses = self.get_responses(e, self.topic_id)
             print(responses)
+            if not responses:
+                return None,
             reply_payload, network_invoice = responses[0][0]
             self.pay_and_read_response(e, reply_payload, network_invoice)
 
@@ -120,35 +147,79 @@ class GridNode(SweetGossipNode):
         self.trace(e, val)
 
 
-def main(sim_id):
+def delivery_stats(things: Dict[str, GridNode], worker_subscriptions: SubscriptionIndex, simulation_started: float) -> dict:
+    """Share of (customer, subscribed gig worker) pairs whose reply reached the customer, messages
+    sent and wall clock time from the start of the simulation to the first reply of every customer."""
+    customers = [t for t in things.values() if t.grid_node_type == GridNodeType.Customer]
+    pairs = delivered = 0
+    first_reply = list()
+    for customer in customers:
+        expected = {things[s.subscriber].certificate.public_key for s in worker_subscriptions.match(customer.topic)
+                    if s.subscriber != customer.name}
+        replied = set(customer.reply_payloads.get(customer.topic_id, dict()).keys())
+        pairs += len(expected)
+        delivered += len(expected & replied)
+        if customer.topic_id in customer.first_reply_at:
+            first_reply.append(customer.first_reply_at[customer.topic_id]-simulation_started)
+    return {
+        "delivery_ratio": delivered/pairs if pairs else 0.0,
+        "messages": sum(t.messages_sent for t in things.values()),
+        "customers_with_reply": len(first_reply),
+        "customers": len(customers),
+        "mean_time_to_first_reply": sum(first_reply)/len(first_reply) if first_reply else None,
+    }
+
+
+def main(sim_id, crypto_suite: str = CRYPTO_SUITE, keystore_dir: str = KEYSTORE_DIR,
+         peer_selection: PeerSelectionStrategy = None, stats: dict = None):
     history = list()
     with Stopwatch() as sw:
         def printMessages(msgs):
             for m in msgs:
                 print(m)
 
-        ca = create_certification_authority("CA")
-        ca_certificate = ca.issue_certificate(
+        GRID_SHAPE = (10, 10)
+
+        keystore = KeyStore(None if keystore_dir is None else keystore_path(keystore_dir, crypto_suite),
+                            crypto_suite)
+        node_names = [f"GridNode<{nod_idx}>" for nod_idx in itertools.product(
+            *(range(s) for s in GRID_SHAPE))]
+        keystore.pregenerate(["CA"]+node_names)
+
+        ca = CertificationAuthority("CA", *keystore.get_keys("CA"))
+        ca_certificate = keystore.get_certificate("CA", ca, lambda: ca.issue_certificate(
             ca.ca_public_key, "is_ok", True,
             not_valid_after=datetime.now()+timedelta(days=7),
-            not_valid_before=datetime.now()-timedelta(days=7))
+            not_valid_before=datetime.now()-timedelta(days=7)))
+        keystore.get_certificates(node_names, ca, lambda name, public_key: (
+            public_key, "is_ok", True, datetime.now()+timedelta(days=7), datetime.now()-timedelta(days=7)))
+        liquidity_network = LiquidityNetwork()
         settler = Settler(
             ca_certificate,
             ca._ca_private_key,
-            PaymentChannel(),
+            PaymentChannel(liquidity_network=liquidity_network,
+                           node_id=liquidity_network.add_node("Settler", CHANNEL_BALANCE, CHANNEL_CAPACITY)),
             price_amount_for_settlement=12)
 
         things: Dict[str, GridNode] = dict()
-
-        GRID_SHAPE = (10, 10)
+        # every gig worker registers here as well, the share of them reached is in the stats
+        worker_subscriptions = SubscriptionIndex()
 
         for nod_idx in itertools.product(*(range(s) for s in GRID_SHAPE)):
             node_name = f"GridNode<{nod_idx}>"
             things[node_name] = GridNode(node_name,
                                          ca,
                                          1,
-                                         settler)
+                                         settler,
+                                         keystore,
+                                         liquidity_network,
+                                         geohash=pgh.encode(latitude=GRID_ORIGIN[0]-GRID_SPACING*nod_idx[0],
+                                                            longitude=GRID_ORIGIN[1]-GRID_SPACING*nod_idx[1],
+                                                            precision=7),
+                                         peer_selection=peer_selection,
+                                         worker_subscriptions=worker_subscriptions)
 #            print(node_name, ":", things[node_name].payment_channel)
+        keystore.save()
 
         already = set()
         for nod_idx in itertools.product(*(range(s) for s in GRID_SHAPE)):
@@ -180,6 +251,9 @@ def main(sim_id):
             things_list[start_idx].set_grid_node_type(GridNodeType.Customer)
             things_list[end_idx].set_grid_node_type(GridNodeType.GigWorker)
 
+        print("subscription summaries settled after", propagate_subscription_summaries(things_list), "rounds")
+
+        simulation_started = timer()
         simulate(sim_id, things, until=float('inf'),
                  history=history, message_flow_in_trace=False)
 
@@ -188,10 +262,16 @@ def main(sim_id):
                 print(a)
                 printMessages(things[a].queue.items)
 
+        liquidity_network.print_report()
+
+        if stats is not None:
+            stats.update(delivery_stats(things, worker_subscriptions, simulation_started))
+
     print(sw.total)
     return history
 
 
-h = main(sim_id="")
+if __name__ == "__main__":
+    h = main(sim_id="")
 
 # %%
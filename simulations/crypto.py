@@ -1,91 +1,116 @@
-from typing import Tuple, List
-from cryptography.hazmat.primitives.asymmetric import rsa, padding, utils
+from __future__ import annotations
+
+from typing import Any, Dict, Tuple, List, Union
+from cryptography.hazmat.primitives.asymmetric import rsa, padding, utils, x25519, ed25519
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.exceptions import InvalidSignature
 from cryptography.fernet import Fernet
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import base64
+import io
+import os
 import pickle
+import struct
 
+import canonical
 
-def generate_asymetric_keys() -> Tuple[bytes, bytes]:
-    priv_key = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=2048,
-    )
-    private_key = priv_key.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.TraditionalOpenSSL,
-        encryption_algorithm=serialization.NoEncryption())
+KEY_CACHE_SIZE = 1024
+VERIFY_MAX_WORKERS = os.cpu_count() or 1
+STREAM_CHUNK_SIZE = 64*1024
+SYMMETRIC_MODE = "aesgcm"
 
-    pub_key = priv_key.public_key()
-    public_key = pub_key.public_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo)
 
-    return private_key, public_key
+class CryptoSuite:
+    name: str = None
 
+    def owns_key(self, key: bytes) -> bool:
+        raise NotImplementedError()
 
-def encrypt_object(obj, public_key: bytes) -> bytes:
-    pub_key = serialization.load_pem_public_key(
-        public_key
-    )
-    bobj = pickle.dumps(obj)
-    key = Fernet.generate_key()
-    ebobj = Fernet(key).encrypt(bobj)
-    ekey = pub_key.encrypt(key,
-                           padding.OAEP(
-                               mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                               algorithm=hashes.SHA256(),
-                               label=None
-                           ))
-    return pickle.dumps((ekey, ebobj))
-
-
-def decrypt_object(blob: bytes, private_key: bytes):
-    priv_key = serialization.load_pem_private_key(
-        private_key,
-        password=None,
-    )
-    ekey, ebobj = pickle.loads(blob)
-    key = priv_key.decrypt(ekey,
-                           padding.OAEP(
-                               mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                               algorithm=hashes.SHA256(),
-                               label=None
-                           ))
-    bobj = Fernet(key).decrypt(ebobj)
-    return pickle.loads(bobj)
+    def generate_asymetric_keys(self) -> Tuple[bytes, bytes]:
+        raise NotImplementedError()
 
+    def load_public_key(self, public_key: bytes):
+        raise NotImplementedError()
 
-def sign_object(obj, private_key: bytes) -> bytes:
-    priv_key = serialization.load_pem_private_key(
-        private_key,
-        password=None,
-    )
-    bobj = pickle.dumps(obj)
-    chosen_hash = hashes.SHA256()
-    hasher = hashes.Hash(chosen_hash)
-    hasher.update(bobj)
-    return priv_key.sign(
-        hasher.finalize(),
-        padding.PSS(
-            mgf=padding.MGF1(hashes.SHA256()),
-            salt_length=padding.PSS.MAX_LENGTH
-        ),
-        utils.Prehashed(chosen_hash)
-    )
-
-
-def verify_object(obj, signature: bytes, public_key: bytes) -> bool:
-    pub_key = serialization.load_pem_public_key(
-        public_key
-    )
-    bobj = pickle.dumps(obj)
-    chosen_hash = hashes.SHA256()
-    hasher = hashes.Hash(chosen_hash)
-    hasher.update(bobj)
-    try:
-        pub_key.verify(
-            signature,
+    def load_private_key(self, private_key: bytes):
+        raise NotImplementedError()
+
+    def encrypt(self, pub_key, bobj: bytes) -> bytes:
+        raise NotImplementedError()
+
+    def decrypt(self, priv_key, blob: bytes) -> bytes:
+        raise NotImplementedError()
+
+    def sign(self, priv_key, bobj: bytes) -> bytes:
+        raise NotImplementedError()
+
+    def verify(self, pub_key, signature: bytes, bobj: bytes) -> bool:
+        raise NotImplementedError()
+
+
+class RSACryptoSuite(CryptoSuite):
+    name = "rsa"
+
+    def owns_key(self, key: bytes) -> bool:
+        return key.startswith(b"-----BEGIN")
+
+    def generate_asymetric_keys(self) -> Tuple[bytes, bytes]:
+        priv_key = rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=2048,
+        )
+        private_key = priv_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            encryption_algorithm=serialization.NoEncryption())
+
+        pub_key = priv_key.public_key()
+        public_key = pub_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo)
+
+        return private_key, public_key
+
+    def load_public_key(self, public_key: bytes):
+        return serialization.load_pem_public_key(
+            public_key
+        )
+
+    def load_private_key(self, private_key: bytes):
+        return serialization.load_pem_private_key(
+            private_key,
+            password=None,
+        )
+
+    def encrypt(self, pub_key, bobj: bytes) -> bytes:
+        key = Fernet.generate_key()
+        ebobj = Fernet(key).encrypt(bobj)
+        ekey = pub_key.encrypt(key,
+                               padding.OAEP(
+                                   mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                                   algorithm=hashes.SHA256(),
+                                   label=None
+                               ))
+        return pickle.dumps((ekey, ebobj))
+
+    def decrypt(self, priv_key, blob: bytes) -> bytes:
+        ekey, ebobj = pickle.loads(blob)
+        key = priv_key.decrypt(ekey,
+                               padding.OAEP(
+                                   mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                                   algorithm=hashes.SHA256(),
+                                   label=None
+                               ))
+        return Fernet(key).decrypt(ebobj)
+
+    def sign(self, priv_key, bobj: bytes) -> bytes:
+        chosen_hash = hashes.SHA256()
+        hasher = hashes.Hash(chosen_hash)
+        hasher.update(bobj)
+        return priv_key.sign(
             hasher.finalize(),
             padding.PSS(
                 mgf=padding.MGF1(hashes.SHA256()),
@@ -93,9 +118,426 @@ def verify_object(obj, signature: bytes, public_key: bytes) -> bool:
             ),
             utils.Prehashed(chosen_hash)
         )
+
+    def verify(self, pub_key, signature: bytes, bobj: bytes) -> bool:
+        chosen_hash = hashes.SHA256()
+        hasher = hashes.Hash(chosen_hash)
+        hasher.update(bobj)
+        try:
+            pub_key.verify(
+                signature,
+                hasher.finalize(),
+                padding.PSS(
+                    mgf=padding.MGF1(hashes.SHA256()),
+                    salt_length=padding.PSS.MAX_LENGTH
+                ),
+                utils.Prehashed(chosen_hash)
+            )
+            return True
+        except InvalidSignature:
+            return False
+
+
+class X25519CryptoSuite(CryptoSuite):
+    """ECDH (X25519) + ChaCha20-Poly1305 encryption with Ed25519 signatures.
+
+    Keys are raw bytes: a prefix followed by the 32 byte X25519 key and the 32 byte Ed25519 key.
+    Ciphertexts are the ephemeral X25519 public key, a 12 byte nonce and the AEAD output.
+    """
+    name = "x25519"
+    KEY_PREFIX = b"X25519ED25519:"
+
+    def owns_key(self, key: bytes) -> bool:
+        return key.startswith(self.KEY_PREFIX)
+
+    def generate_asymetric_keys(self) -> Tuple[bytes, bytes]:
+        dh_key = x25519.X25519PrivateKey.generate()
+        sig_key = ed25519.Ed25519PrivateKey.generate()
+        raw = (serialization.Encoding.Raw, serialization.PrivateFormat.Raw, serialization.NoEncryption())
+        private_key = self.KEY_PREFIX + dh_key.private_bytes(*raw) + sig_key.private_bytes(*raw)
+        public_key = self.KEY_PREFIX + \
+            dh_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw) + \
+            sig_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        return private_key, public_key
+
+    def load_public_key(self, public_key: bytes):
+        raw = public_key[len(self.KEY_PREFIX):]
+        return (x25519.X25519PublicKey.from_public_bytes(raw[:32]),
+                ed25519.Ed25519PublicKey.from_public_bytes(raw[32:]),
+                raw[:32])
+
+    def load_private_key(self, private_key: bytes):
+        raw = private_key[len(self.KEY_PREFIX):]
+        dh_key = x25519.X25519PrivateKey.from_private_bytes(raw[:32])
+        return (dh_key,
+                ed25519.Ed25519PrivateKey.from_private_bytes(raw[32:]),
+                dh_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw))
+
+    def _derive_key(self, shared_key: bytes, ephemeral_public: bytes, recipient_public: bytes) -> bytes:
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=ephemeral_public+recipient_public,
+            info=b"gig-gossip x25519-chacha20poly1305",
+        ).derive(shared_key)
+
+    def encrypt(self, pub_key, bobj: bytes) -> bytes:
+        dh_pub, _, dh_pub_raw = pub_key
+        ephemeral = x25519.X25519PrivateKey.generate()
+        ephemeral_public = ephemeral.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        key = self._derive_key(ephemeral.exchange(dh_pub), ephemeral_public, dh_pub_raw)
+        nonce = os.urandom(12)
+        return ephemeral_public + nonce + ChaCha20Poly1305(key).encrypt(nonce, bobj, None)
+
+    def decrypt(self, priv_key, blob: bytes) -> bytes:
+        dh_key, _, dh_pub_raw = priv_key
+        ephemeral_public, nonce, ebobj = blob[:32], blob[32:44], blob[44:]
+        key = self._derive_key(dh_key.exchange(x25519.X25519PublicKey.from_public_bytes(ephemeral_public)),
+                               ephemeral_public, dh_pub_raw)
+        return ChaCha20Poly1305(key).decrypt(nonce, ebobj, None)
+
+    def sign(self, priv_key, bobj: bytes) -> bytes:
+        return priv_key[1].sign(bobj)
+
+    def verify(self, pub_key, signature: bytes, bobj: bytes) -> bool:
+        try:
+            pub_key[1].verify(signature, bobj)
+            return True
+        except InvalidSignature:
+            return False
+
+
+CRYPTO_SUITE_BY_NAME: Dict[str, CryptoSuite] = dict()
+DEFAULT_CRYPTO_SUITE = "rsa"
+
+
+def register_crypto_suite(suite: CryptoSuite) -> CryptoSuite:
+    global CRYPTO_SUITE_BY_NAME
+    CRYPTO_SUITE_BY_NAME[suite.name] = suite
+    return suite
+
+
+def get_crypto_suite_by_name(name: str) -> CryptoSuite:
+    global CRYPTO_SUITE_BY_NAME
+    if name in CRYPTO_SUITE_BY_NAME:
+        return CRYPTO_SUITE_BY_NAME[name]
+    raise KeyError(f"unknown crypto suite {name}")
+
+
+def get_crypto_suite_of_key(key: bytes) -> CryptoSuite:
+    global CRYPTO_SUITE_BY_NAME
+    for suite in CRYPTO_SUITE_BY_NAME.values():
+        if suite.owns_key(key):
+            return suite
+    raise ValueError("key does not belong to any registered crypto suite")
+
+
+register_crypto_suite(RSACryptoSuite())
+register_crypto_suite(X25519CryptoSuite())
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def _load_public_key(public_key: bytes):
+    suite = get_crypto_suite_of_key(public_key)
+    return suite, suite.load_public_key(public_key)
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def _load_private_key(private_key: bytes):
+    suite = get_crypto_suite_of_key(private_key)
+    return suite, suite.load_private_key(private_key)
+
+
+def clear_key_cache() -> None:
+    _load_public_key.cache_clear()
+    _load_private_key.cache_clear()
+
+
+class PublicKeyHandle:
+    def __init__(self, public_key: bytes) -> None:
+        self.public_key = public_key
+        self._key = None
+
+    @property
+    def key(self):
+        if self._key is None:
+            self._key = _load_public_key(self.public_key)
+        return self._key
+
+    @property
+    def crypto_suite(self) -> CryptoSuite:
+        return self.key[0]
+
+    def __getstate__(self):
+        return {"public_key": self.public_key, "_key": None}
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, PublicKeyHandle) and other.public_key == self.public_key
+
+    def __hash__(self) -> int:
+        return hash(self.public_key)
+
+    def __repr__(self) -> str:
+        return f"PublicKeyHandle(<{len(self.public_key)}>)"
+
+
+class KeyPair:
+    def __init__(self, private_key: bytes, public_key: bytes) -> None:
+        self.private_key = private_key
+        self.public = PublicKeyHandle(public_key)
+        self._key = None
+
+    @property
+    def public_key(self) -> bytes:
+        return self.public.public_key
+
+    @property
+    def key(self):
+        if self._key is None:
+            self._key = _load_private_key(self.private_key)
+        return self._key
+
+    @property
+    def crypto_suite(self) -> CryptoSuite:
+        return self.key[0]
+
+    def __getstate__(self):
+        return {"private_key": self.private_key, "public": self.public, "_key": None}
+
+    def __iter__(self):
+        return iter((self.private_key, self.public_key))
+
+    def __repr__(self) -> str:
+        return f"KeyPair(<{len(self.public_key)}>)"
+
+
+PublicKey = Union[bytes, PublicKeyHandle, KeyPair]
+PrivateKey = Union[bytes, KeyPair]
+
+
+def _as_public_key(public_key: PublicKey):
+    if isinstance(public_key, KeyPair):
+        return public_key.public.key
+    if isinstance(public_key, PublicKeyHandle):
+        return public_key.key
+    return _load_public_key(public_key)
+
+
+def _as_private_key(private_key: PrivateKey):
+    if isinstance(private_key, KeyPair):
+        return private_key.key
+    return _load_private_key(private_key)
+
+
+def generate_asymetric_keys(crypto_suite: str = DEFAULT_CRYPTO_SUITE) -> Tuple[bytes, bytes]:
+    return get_crypto_suite_by_name(crypto_suite).generate_asymetric_keys()
+
+
+def generate_key_pair(crypto_suite: str = DEFAULT_CRYPTO_SUITE) -> KeyPair:
+    return KeyPair(*generate_asymetric_keys(crypto_suite))
+
+
+def encrypt_object(obj, public_key: PublicKey) -> bytes:
+    suite, pub_key = _as_public_key(public_key)
+    return suite.encrypt(pub_key, pickle.dumps(obj))
+
+
+def decrypt_object(blob: bytes, private_key: PrivateKey):
+    suite, priv_key = _as_private_key(private_key)
+    return pickle.loads(suite.decrypt(priv_key, blob))
+
+
+def sign_object(obj, private_key: PrivateKey) -> bytes:
+    suite, priv_key = _as_private_key(private_key)
+    return suite.sign(priv_key, canonical.signing_bytes(obj))
+
+
+def verify_object(obj, signature: bytes, public_key: PublicKey) -> bool:
+    suite, pub_key = _as_public_key(public_key)
+    return suite.verify(pub_key, signature, canonical.signing_bytes(obj))
+
+
+_verify_executor: ThreadPoolExecutor = None
+
+
+def _get_verify_executor() -> ThreadPoolExecutor:
+    global _verify_executor
+    if _verify_executor is None:
+        _verify_executor = ThreadPoolExecutor(
+            max_workers=VERIFY_MAX_WORKERS, thread_name_prefix="verify")
+    return _verify_executor
+
+
+def verify_many(items: List[Tuple[Any, bytes, PublicKey]]) -> List[bool]:
+    # objects are encoded on the calling thread so callers may mutate them right after,
+    # only the signature checks (which release the GIL) are fanned out
+    jobs = []
+    for obj, signature, public_key in items:
+        suite, pub_key = _as_public_key(public_key)
+        jobs.append((suite.verify, pub_key, signature, canonical.signing_bytes(obj)))
+
+    if len(jobs) < 2 or VERIFY_MAX_WORKERS < 2:
+        return [verify(pub_key, signature, bobj) for verify, pub_key, signature, bobj in jobs]
+
+    futures = [_get_verify_executor().submit(*job) for job in jobs]
+    return [f.result() for f in futures]
+
+
+# Streaming container: STREAM_MAGIC, wrapped key length and the content key wrapped with the
+# recipient's suite, a 7 byte nonce prefix and then chunks of [final flag | length | ciphertext].
+# Each chunk is sealed with ChaCha20-Poly1305 under nonce = prefix | counter | final flag, so
+# reordered, dropped or truncated chunks fail to decrypt.
+STREAM_MAGIC = b"GGSTREAM\x01"
+_STREAM_CHUNK_HEADER = struct.Struct(">BI")
+
+
+def _stream_nonce(prefix: bytes, counter: int, final: bool) -> bytes:
+    return prefix + counter.to_bytes(4, "big") + (b"\x01" if final else b"\x00")
+
+
+def _read_exactly(src, n: int) -> bytes:
+    data = src.read(n)
+    while len(data) < n:
+        more = src.read(n - len(data))
+        if not more:
+            raise ValueError("truncated encrypted stream")
+        data += more
+    return data
+
+
+class StreamEncryptor(io.RawIOBase):
+    def __init__(self, dst, public_key: PublicKey, chunk_size: int = STREAM_CHUNK_SIZE) -> None:
+        super().__init__()
+        suite, pub_key = _as_public_key(public_key)
+        key = ChaCha20Poly1305.generate_key()
+        wrapped_key = suite.encrypt(pub_key, key)
+        self._aead = ChaCha20Poly1305(key)
+        self._prefix = os.urandom(7)
+        self._counter = 0
+        self._dst = dst
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        dst.write(STREAM_MAGIC + struct.pack(">I", len(wrapped_key)) + wrapped_key + self._prefix)
+
+    def writable(self) -> bool:
+        return True
+
+    def _seal(self, chunk, final: bool) -> None:
+        if self._counter >= 1 << 32:
+            raise OverflowError("too many chunks in encrypted stream")
+        sealed = self._aead.encrypt(_stream_nonce(self._prefix, self._counter, final), chunk, None)
+        self._counter += 1
+        self._dst.write(_STREAM_CHUNK_HEADER.pack(final, len(sealed)))
+        self._dst.write(sealed)
+
+    def write(self, b) -> int:
+        view = memoryview(b).cast("B")
+        n = len(view)
+        if self._buffer:
+            take = min(n, self._chunk_size-len(self._buffer))
+            self._buffer += view[:take]
+            view = view[take:]
+            if len(self._buffer) < self._chunk_size or not len(view):
+                return n
+            self._seal(self._buffer, False)
+            self._buffer = bytearray()
+        while len(view) > self._chunk_size:
+            self._seal(view[:self._chunk_size], False)
+            view = view[self._chunk_size:]
+        self._buffer += view
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self._seal(self._buffer, True)
+            self._buffer = bytearray()
+        super().close()
+
+    def abort(self) -> None:
+        # closes without the final chunk, so the decryptor reports the stream as truncated
+        self._buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def __del__(self) -> None:
+        # a stream is only complete when close() is called, never when it is collected
+        if not self.closed:
+            self.abort()
+
+
+class StreamDecryptor(io.RawIOBase):
+    def __init__(self, src, private_key: PrivateKey) -> None:
+        super().__init__()
+        if _read_exactly(src, len(STREAM_MAGIC)) != STREAM_MAGIC:
+            raise ValueError("not an encrypted stream")
+        suite, priv_key = _as_private_key(private_key)
+        wrapped_key_len, = struct.unpack(">I", _read_exactly(src, 4))
+        self._aead = ChaCha20Poly1305(suite.decrypt(priv_key, _read_exactly(src, wrapped_key_len)))
+        self._prefix = _read_exactly(src, 7)
+        self._counter = 0
+        self._src = src
+        self._chunk = memoryview(b"")
+        self._final = False
+
+    def readable(self) -> bool:
+        return True
+
+    def _next_chunk(self) -> bool:
+        if self._final:
+            return False
+        final, length = _STREAM_CHUNK_HEADER.unpack(_read_exactly(self._src, _STREAM_CHUNK_HEADER.size))
+        self._chunk = memoryview(self._aead.decrypt(
+            _stream_nonce(self._prefix, self._counter, bool(final)), _read_exactly(self._src, length), None))
+        self._counter += 1
+        self._final = bool(final)
         return True
-    except InvalidSignature:
-        return False
+
+    def readinto(self, b) -> int:
+        view = memoryview(b).cast("B")
+        while not len(self._chunk):
+            if not self._next_chunk():
+                return 0
+        n = min(len(view), len(self._chunk))
+        view[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+
+def encrypt_stream(src, dst, public_key: PublicKey, chunk_size: int = STREAM_CHUNK_SIZE) -> None:
+    with StreamEncryptor(dst, public_key, chunk_size) as encryptor:
+        if isinstance(src, (bytes, bytearray, memoryview)):
+            encryptor.write(src)
+            return
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            encryptor.write(chunk)
+
+
+def decrypt_stream(src, dst, private_key: PrivateKey, chunk_size: int = STREAM_CHUNK_SIZE) -> None:
+    decryptor = StreamDecryptor(src, private_key)
+    buffer = bytearray(chunk_size)
+    while True:
+        n = decryptor.readinto(buffer)
+        if n == 0:
+            break
+        dst.write(memoryview(buffer)[:n])
+
+
+def encrypt_object_to_stream(obj, dst, public_key: PublicKey, chunk_size: int = STREAM_CHUNK_SIZE) -> None:
+    with StreamEncryptor(dst, public_key, chunk_size) as encryptor:
+        pickle.dump(obj, encryptor, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decrypt_object_from_stream(src, private_key: PrivateKey):
+    return pickle.load(io.BufferedReader(StreamDecryptor(src, private_key)))
 
 
 def _compute_hash(items: list, chosen_hash) -> bytes:
@@ -117,11 +559,25 @@ def generate_symmetric_key() -> bytes:
     return Fernet.generate_key()
 
 
-def symmetric_encrypt(key: bytes, obj) -> bytes:
+# Binary AES-256-GCM blobs are a version byte, a 12 byte nonce and the ciphertext with its tag.
+# Fernet tokens are urlsafe base64 text and never start with the version byte, so both decrypt.
+SYMMETRIC_AESGCM_VERSION = b"\x01"
+
+
+def symmetric_encrypt(key: bytes, obj, mode: str = None) -> bytes:
     bobj = pickle.dumps(obj)
-    return Fernet(key).encrypt(bobj)
+    mode = SYMMETRIC_MODE if mode is None else mode
+    if mode == "aesgcm":
+        nonce = os.urandom(12)
+        return SYMMETRIC_AESGCM_VERSION + nonce + AESGCM(base64.urlsafe_b64decode(key)).encrypt(nonce, bobj, SYMMETRIC_AESGCM_VERSION)
+    if mode == "fernet":
+        return Fernet(key).encrypt(bobj)
+    raise ValueError(f"unknown symmetric mode {mode}")
 
 
 def symmetric_decrypt(key: bytes, ebobj: bytes):
-    bobj = Fernet(key).decrypt(ebobj)
+    if ebobj[:1] == SYMMETRIC_AESGCM_VERSION:
+        bobj = AESGCM(base64.urlsafe_b64decode(key)).decrypt(ebobj[1:13], ebobj[13:], SYMMETRIC_AESGCM_VERSION)
+    else:
+        bobj = Fernet(key).decrypt(ebobj)
     return pickle.loads(bobj)
@@ -0,0 +1,311 @@
+# %%
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tracemalloc
+from datetime import datetime
+from timeit import default_timer as timer
+
+import canonical
+import crypto
+import payments
+import pow
+from stopwatch import Stopwatch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+import schnorr_lib
+
+BENCH_SECONDS = 2.0
+PAYLOAD_SIZES = (64, 1024, 64*1024)
+POW_COMPLEXITY = 16
+MIN_BATCH_SECONDS = 0.0005
+BASELINE_PATH = "crypto_bench_baseline.json"
+REGRESSION_TOLERANCE = 0.2
+
+
+def ops_per_sec(fn, seconds=BENCH_SECONDS):
+    ops = 0
+    with Stopwatch() as sw:
+        while sw.elapsed < seconds:
+            fn()
+            ops += 1
+    return ops/sw.total
+
+
+def measure(fn, seconds=BENCH_SECONDS, min_samples=5):
+    # fast primitives are timed in batches so timer overhead does not dominate,
+    # every batch contributes one latency sample (its mean per call)
+    batch = 1
+    while True:
+        start = timer()
+        for _ in range(batch):
+            fn()
+        if timer()-start >= MIN_BATCH_SECONDS or batch >= 1 << 20:
+            break
+        batch *= 2
+
+    samples = []
+    calls = 0
+    with Stopwatch() as sw:
+        while sw.elapsed < seconds or len(samples) < min_samples:
+            start = timer()
+            for _ in range(batch):
+                fn()
+            samples.append((timer()-start)/batch)
+            calls += batch
+    samples.sort()
+
+    def percentile(q):
+        return samples[min(len(samples)-1, int(q*len(samples)))]*1e6
+
+    return {
+        "ops_per_sec": calls/sw.total,
+        "p50_us": percentile(0.50),
+        "p90_us": percentile(0.90),
+        "p99_us": percentile(0.99),
+        "max_us": samples[-1]*1e6,
+        "samples": len(samples),
+    }
+
+
+def primitive_cases(sizes=PAYLOAD_SIZES):
+    for suite in crypto.CRYPTO_SUITE_BY_NAME:
+        yield f"crypto.generate_asymetric_keys[{suite}]", None, lambda suite=suite: crypto.generate_asymetric_keys(suite)
+    yield "crypto.generate_symmetric_key", None, crypto.generate_symmetric_key
+    yield "payments.compute_payment_hash", 32, lambda preimage=crypto.generate_symmetric_key(): payments.compute_payment_hash(preimage)
+    seckey = random.randbytes(32)
+    pubkey = schnorr_lib.pubkey_gen(seckey)
+    yield "schnorr_lib.pubkey_gen", None, lambda: schnorr_lib.pubkey_gen(seckey)
+
+    for size in sizes:
+        data = random.randbytes(size)
+        for suite in crypto.CRYPTO_SUITE_BY_NAME:
+            private_key, public_key = crypto.generate_asymetric_keys(suite)
+            blob = crypto.encrypt_object(data, public_key)
+            signature = crypto.sign_object(data, private_key)
+            stream = io.BytesIO()
+            crypto.encrypt_stream(data, stream, public_key)
+            stream = stream.getvalue()
+            yield f"crypto.encrypt_object[{suite}]", size, lambda public_key=public_key: crypto.encrypt_object(data, public_key)
+            yield f"crypto.decrypt_object[{suite}]", size, lambda blob=blob, private_key=private_key: crypto.decrypt_object(blob, private_key)
+            yield f"crypto.sign_object[{suite}]", size, lambda private_key=private_key: crypto.sign_object(data, private_key)
+            yield f"crypto.verify_object[{suite}]", size, lambda signature=signature, public_key=public_key: crypto.verify_object(data, signature, public_key)
+            yield f"crypto.verify_many[{suite}]x4", size, lambda signature=signature, public_key=public_key: crypto.verify_many([(data, signature, public_key)]*4)
+            yield f"crypto.encrypt_stream[{suite}]", size, lambda public_key=public_key: crypto.encrypt_stream(data, io.BytesIO(), public_key)
+            yield f"crypto.decrypt_stream[{suite}]", size, lambda stream=stream, private_key=private_key: crypto.decrypt_stream(io.BytesIO(stream), io.BytesIO(), private_key)
+
+        key = crypto.generate_symmetric_key()
+        for mode in ("aesgcm", "fernet"):
+            eblob = crypto.symmetric_encrypt(key, data, mode)
+            yield f"crypto.symmetric_encrypt[{mode}]", size, lambda mode=mode: crypto.symmetric_encrypt(key, data, mode)
+            yield f"crypto.symmetric_decrypt[{mode}]", size, lambda eblob=eblob: crypto.symmetric_decrypt(key, eblob)
+
+        yield "crypto.compute_sha256", size, lambda: crypto.compute_sha256([data])
+        yield "crypto.compute_sha512", size, lambda: crypto.compute_sha512([data])
+
+        pow_target = pow.pow_target_from_complexity("sha256", POW_COMPLEXITY)
+        nuance = pow.compute_pow(data, "sha256", pow_target)
+        yield f"pow.compute_pow[{POW_COMPLEXITY}]", size, lambda: pow.compute_pow(data, "sha256", pow_target)
+        yield "pow.validate_pow", size, lambda: pow.validate_pow(data, nuance, "sha256", pow_target)
+
+        schnorr_signature = schnorr_lib.schnorr_sign(data, seckey, bytes(32))
+        yield "schnorr_lib.schnorr_sign", size, lambda: schnorr_lib.schnorr_sign(data, seckey, bytes(32))
+        yield "schnorr_lib.schnorr_verify", size, lambda: schnorr_lib.schnorr_verify(data, pubkey, schnorr_signature)
+
+
+def run_benchmarks(sizes=PAYLOAD_SIZES, seconds=BENCH_SECONDS, only: str = None):
+    results = dict()
+    for name, size, fn in primitive_cases(sizes):
+        if only is not None and only not in name:
+            continue
+        key = name if size is None else f"{name}@{size}"
+        results[key] = measure(fn, seconds)
+        r = results[key]
+        print(f"{key:48} {r['ops_per_sec']:12.1f} ops/s  p50={r['p50_us']:10.1f}us  p90={r['p90_us']:10.1f}us  p99={r['p99_us']:10.1f}us")
+    return {
+        "created": datetime.now().isoformat(),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "seconds": seconds,
+        "results": results,
+    }
+
+
+def compare_to_baseline(report, baseline, tolerance=REGRESSION_TOLERANCE):
+    regressions = []
+    for key, r in report["results"].items():
+        if key not in baseline["results"]:
+            continue
+        ratio = r["ops_per_sec"]/baseline["results"][key]["ops_per_sec"]
+        mark = ""
+        if ratio < 1-tolerance:
+            regressions.append((key, ratio))
+            mark = "  REGRESSION"
+        print(f"{key:48} x{ratio:6.2f}{mark}")
+    return regressions
+
+
+def bench_key_cache():
+    key_pair = crypto.generate_key_pair()
+    private_key, public_key = key_pair
+    obj = ["ala", ["ma", "kota"]]*10
+    signature = crypto.sign_object(obj, private_key)
+    blob = crypto.encrypt_object(obj, public_key)
+
+    cases = {
+        "encrypt_object": lambda k: crypto.encrypt_object(obj, k[1]),
+        "decrypt_object": lambda k: crypto.decrypt_object(blob, k[0]),
+        "sign_object": lambda k: crypto.sign_object(obj, k[0]),
+        "verify_object": lambda k: crypto.verify_object(obj, signature, k[1]),
+    }
+
+    results = dict()
+    for name, case in cases.items():
+        def uncached():
+            crypto.clear_key_cache()
+            case((private_key, public_key))
+
+        before = ops_per_sec(uncached)
+        after_pem = ops_per_sec(lambda: case((private_key, public_key)))
+        after_handle = ops_per_sec(lambda: case((key_pair, key_pair.public)))
+        results[name] = (before, after_pem, after_handle)
+        print(f"{name:16} uncached={before:10.1f} ops/s  cached(pem)={after_pem:10.1f} ops/s  handle={after_handle:10.1f} ops/s  x{after_handle/before:.2f}")
+    return results
+
+
+def bench_crypto_suites():
+    obj = ["ala", ["ma", "kota"]]*10
+    results = dict()
+    for name in crypto.CRYPTO_SUITE_BY_NAME:
+        private_key, public_key = crypto.generate_asymetric_keys(name)
+        blob = crypto.encrypt_object(obj, public_key)
+        signature = crypto.sign_object(obj, private_key)
+        results[name] = {
+            "generate_asymetric_keys": ops_per_sec(lambda: crypto.generate_asymetric_keys(name)),
+            "encrypt_object": ops_per_sec(lambda: crypto.encrypt_object(obj, public_key)),
+            "decrypt_object": ops_per_sec(lambda: crypto.decrypt_object(blob, private_key)),
+            "sign_object": ops_per_sec(lambda: crypto.sign_object(obj, private_key)),
+            "verify_object": ops_per_sec(lambda: crypto.verify_object(obj, signature, public_key)),
+        }
+    for op in next(iter(results.values())):
+        print(f"{op:24}", "  ".join(
+            f"{name}={results[name][op]:10.1f} ops/s" for name in results))
+    return results
+
+
+def bench_stream_encryption(sizes=(10_000, 1_000_000, 20_000_000)):
+    private_key, public_key = crypto.generate_asymetric_keys()
+    crypto.decrypt_object(crypto.encrypt_object(b"", public_key), private_key)
+    results = dict()
+    for size in sizes:
+        data = random.randbytes(size)
+
+        def one_shot():
+            crypto.decrypt_object(crypto.encrypt_object(data, public_key), private_key)
+
+        def streamed():
+            enc = io.BytesIO()
+            crypto.encrypt_stream(memoryview(data), enc, public_key)
+            enc.seek(0)
+            crypto.decrypt_stream(enc, io.BytesIO(), private_key)
+
+        row = dict()
+        for name, fn in (("encrypt_object", one_shot), ("encrypt_stream", streamed)):
+            tracemalloc.start()
+            with Stopwatch() as sw:
+                fn()
+            row[name] = (sw.total, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        results[size] = row
+        print(f"{size:10} bytes", "  ".join(
+            f"{name}: {t*1000:8.1f} ms peak={peak/1e6:8.2f} MB" for name, (t, peak) in row.items()))
+    return results
+
+
+def bench_pow_hashing(sizes=PAYLOAD_SIZES, nuances=1 << 16):
+    # with a target of 1 no nonce is a solution, so both loops walk the whole range
+    results = dict()
+    for size in sizes:
+        buf = canonical.encode((random.randbytes(size), "sha256", 0))
+
+        def rehash_loop():
+            for nuance in range(nuances):
+                pow._validate_sha25_pow(buf, nuance, 1)
+
+        def midstate_batches():
+            prefix = hashlib.sha256(buf)
+            for start in range(0, nuances, pow.POW_BATCH_SIZE):
+                pow._sha256_pow_batch(prefix, (1).to_bytes(32, "big"), range(start, min(start+pow.POW_BATCH_SIZE, nuances)))
+
+        row = dict()
+        for name, fn in (("rehash", rehash_loop), ("midstate", midstate_batches)):
+            with Stopwatch() as sw:
+                fn()
+            row[name] = nuances/sw.total
+        results[size] = row
+        print(f"pow {size:8} bytes", "  ".join(
+            f"{name}={hps:12.1f} hashes/s" for name, hps in row.items()), f"x{row['midstate']/row['rehash']:.2f}")
+    return results
+
+
+def bench_complex_sim_suites():
+    import complex_sim
+    from experiment_tools import RANDOM_SEED
+
+    results = dict()
+    for name in crypto.CRYPTO_SUITE_BY_NAME:
+        random.seed(RANDOM_SEED)
+        crypto.clear_key_cache()
+        with Stopwatch() as sw:
+            with contextlib.redirect_stdout(io.StringIO()):
+                complex_sim.main(sim_id=name, crypto_suite=name, keystore_dir=None)
+        results[name] = sw.total
+        print(f"complex_sim {name:10} {sw.total:8.2f} s")
+    return results
+
+
+# %%
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="crypto, pow, payments and schnorr_lib microbenchmarks")
+    parser.add_argument("--seconds", type=float, default=BENCH_SECONDS, help="time budget per case")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(PAYLOAD_SIZES), help="payload sizes in bytes")
+    parser.add_argument("--only", help="run only cases whose name contains this string")
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE, help="allowed relative throughput drop")
+    parser.add_argument("--extras", action="store_true", help="also run the key cache, suite, stream, pow hashing and complex_sim comparisons")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.sizes, args.seconds, args.only)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+    regressions = []
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f), args.tolerance)
+
+    if args.extras:
+        bench_key_cache()
+        bench_crypto_suites()
+        bench_stream_encryption()
+        bench_pow_hashing(args.sizes)
+        bench_complex_sim_suites()
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# %%
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+import heapq
+
+# a ttl is cut into this many buckets, entries outlive their ttl by at most one bucket
+EXPIRING_BUCKETS = 16
+
+
+class ExpiringDict(MutableMapping):
+    """Dict whose entries disappear `ttl` after they were last set.
+
+    Entries are filed in time buckets by expiry and a whole bucket is dropped at once when its
+    time is over, so eviction costs O(1) per entry and runs as a side effect of writes. Reads
+    never return an expired entry, even when its bucket has not been dropped yet.
+    """
+
+    def __init__(self, ttl: timedelta, buckets: int = EXPIRING_BUCKETS) -> None:
+        self.ttl = ttl
+        self._bucket_seconds = max(ttl.total_seconds()/buckets, 1e-6)
+        self._data: Dict[object, Tuple[object, int]] = dict()
+        self._buckets: Dict[int, List[object]] = dict()
+        self._bucket_heap: List[int] = list()
+
+    def _bucket(self, t: datetime) -> int:
+        return int(t.timestamp()//self._bucket_seconds)+1
+
+    def _is_expired(self, bucket: int, now: datetime) -> bool:
+        return bucket*self._bucket_seconds <= now.timestamp()
+
+    def set(self, key, value, ttl: timedelta = None, now: datetime = None) -> None:
+        now = datetime.now() if now is None else now
+        self.evict(now)
+        bucket = self._bucket(now+(self.ttl if ttl is None else ttl))
+        entry = self._data.get(key)
+        self._data[key] = (value, bucket)
+        if entry is not None and entry[1] == bucket:
+            return
+        if bucket not in self._buckets:
+            self._buckets[bucket] = list()
+            heapq.heappush(self._bucket_heap, bucket)
+        self._buckets[bucket].append(key)
+
+    def evict(self, now: datetime = None) -> int:
+        now = datetime.now() if now is None else now
+        evicted = 0
+        while self._bucket_heap and self._is_expired(self._bucket_heap[0], now):
+            bucket = heapq.heappop(self._bucket_heap)
+            for key in self._buckets.pop(bucket):
+                # keys set again since then live in a later bucket
+                entry = self._data.get(key)
+                if entry is not None and entry[1] == bucket:
+                    del self._data[key]
+                    evicted += 1
+        return evicted
+
+    def __setitem__(self, key, value) -> None:
+        self.set(key, value)
+
+    def __getitem__(self, key):
+        value, bucket = self._data[key]
+        if self._is_expired(bucket, datetime.now()):
+            raise KeyError(key)
+        return value
+
+    def __delitem__(self, key) -> None:
+        del self._data[key]
+
+    def __iter__(self):
+        self.evict()
+        return iter(list(self._data))
+
+    def __len__(self) -> int:
+        self.evict()
+        return len(self._data)
+
+    def items(self):
+        self.evict()
+        return [(key, value) for key, (value, _) in self._data.items()]
+
+    def values(self):
+        self.evict()
+        return [value for value, _ in self._data.values()]
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Tuple
+import os
+import pickle
+
+import crypto
+from cert import Certificate, CertificateRequest, CertificationAuthority
+
+
+class KeyStore:
+    """Named key pairs and certificates that survive between simulation runs.
+
+    Missing key pairs are generated in a process pool and everything is pickled to `path`
+    (nothing is persisted when `path` is None). A stored certificate is handed out again only
+    while it is valid and was issued by the same CA key for the same node key.
+    """
+
+    def __init__(self, path: str = None, crypto_suite: str = crypto.DEFAULT_CRYPTO_SUITE) -> None:
+        self.path = path
+        self.crypto_suite = crypto_suite
+        self._keys: Dict[str, Tuple[bytes, bytes]] = dict()
+        self._certificates: Dict[Tuple[str, str], Tuple[bytes, Certificate]] = dict()
+        self._dirty = False
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as f:
+                self._keys, self._certificates = pickle.load(f)
+
+    def pregenerate(self, names: Iterable[str], max_workers: int = None) -> None:
+        missing = [name for name in names if name not in self._keys]
+        if not missing:
+            return
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for name, keys in zip(missing, executor.map(crypto.generate_asymetric_keys,
+                                                        [self.crypto_suite]*len(missing),
+                                                        chunksize=max(1, len(missing)//(4*(os.cpu_count() or 1))))):
+                self._keys[name] = keys
+        self._dirty = True
+
+    def get_keys(self, name: str) -> Tuple[bytes, bytes]:
+        if name not in self._keys:
+            self._keys[name] = crypto.generate_asymetric_keys(self.crypto_suite)
+            self._dirty = True
+        return self._keys[name]
+
+    def _stored_certificate(self, name: str, ca: CertificationAuthority) -> Certificate:
+        _, public_key = self.get_keys(name)
+        if (ca.ca_name, name) in self._certificates:
+            ca_public_key, certificate = self._certificates[(ca.ca_name, name)]
+            if ca_public_key == ca.ca_public_key and certificate.public_key == public_key \
+                    and certificate.not_valid_before <= datetime.now() <= certificate.not_valid_after:
+                return certificate
+        return None
+
+    def _store_certificate(self, name: str, ca: CertificationAuthority, certificate: Certificate) -> None:
+        self._certificates[(ca.ca_name, name)] = (ca.ca_public_key, certificate)
+        self._dirty = True
+
+    def get_certificate(self, name: str, ca: CertificationAuthority, issue: Callable[[], Certificate]) -> Certificate:
+        certificate = self._stored_certificate(name, ca)
+        if certificate is None:
+            certificate = issue()
+            self._store_certificate(name, ca, certificate)
+        return certificate
+
+    def get_certificates(self, names: Iterable[str], ca: CertificationAuthority,
+                         request: Callable[[str, bytes], CertificateRequest],
+                         max_workers: int = None) -> List[Certificate]:
+        names = list(names)
+        missing = [name for name in names if self._stored_certificate(name, ca) is None]
+        issued = ca.issue_certificates([request(name, self.get_keys(name)[1]) for name in missing], max_workers)
+        for name, certificate in zip(missing, issued):
+            self._store_certificate(name, ca, certificate)
+        return [self._stored_certificate(name, ca) for name in names]
+
+    def save(self) -> None:
+        if self.path is None or not self._dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path+".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((self._keys, self._certificates), f)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+def keystore_path(directory: str, crypto_suite: str) -> str:
+    return os.path.join(directory, f"{crypto_suite}.keystore")
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+from array import array
+from typing import Dict, List, Tuple
+from uuid import UUID
+
+import numpy as np
+
+INITIAL_NODES = 64
+
+# why a payment could not be locked
+FAILED_OUTBOUND = 0  # the payer lacks the balance
+FAILED_INBOUND = 1  # the payee would go over its capacity
+
+
+class LiquidityNetwork:
+    """Balances and capacities of the payment channels of a simulation, indexed by node id.
+
+    Accepting a HODL invoice locks its amount on the payer and reserves room on the payee; the
+    lock fails, and the failure is logged, when either side lacks liquidity. Settling moves the
+    amount and logs the transfer with the routing fee the payee charged for it. Per node
+    figures are only aggregated from the logs in `report`, at the end of a run.
+    """
+
+    def __init__(self, initial_nodes: int = INITIAL_NODES) -> None:
+        self.node_names: List[str] = list()
+        self._node_ids: Dict[str, int] = dict()
+        self.balances = np.zeros(initial_nodes, dtype=np.int64)
+        self.capacities = np.zeros(initial_nodes, dtype=np.int64)
+        self.locked_out = np.zeros(initial_nodes, dtype=np.int64)
+        self.locked_in = np.zeros(initial_nodes, dtype=np.int64)
+        self._invoices: Dict[UUID, Tuple[int, int]] = dict()
+        self._locks: Dict[UUID, Tuple[int, int, int, int]] = dict()
+        self._transfers = {k: array("q") for k in ("payer", "payee", "amount", "fee")}
+        self._failures = {k: array("q") for k in ("payer", "payee", "amount", "reason")}
+
+    def __len__(self) -> int:
+        return len(self.node_names)
+
+    def add_node(self, name: str, balance: int, capacity: int) -> int:
+        if name in self._node_ids:
+            raise ValueError(f"node {name} already has channels")
+        node_id = len(self.node_names)
+        if node_id == len(self.balances):
+            for k in ("balances", "capacities", "locked_out", "locked_in"):
+                setattr(self, k, np.concatenate([getattr(self, k), np.zeros_like(getattr(self, k))]))
+        self.node_names.append(name)
+        self._node_ids[name] = node_id
+        self.balances[node_id] = balance
+        self.capacities[node_id] = capacity
+        return node_id
+
+    def get_node_id(self, name: str) -> int:
+        return self._node_ids[name]
+
+    def open_invoice(self, invoice_id: UUID, payee: int, routing_fee: int = 0) -> None:
+        self._invoices[invoice_id] = (payee, routing_fee)
+
+    def lock(self, invoice_id: UUID, payer: int, amount: int) -> bool:
+        if invoice_id not in self._invoices:
+            return True
+        payee, fee = self._invoices[invoice_id]
+        if self.balances[payer]-self.locked_out[payer] < amount:
+            reason = FAILED_OUTBOUND
+        elif self.balances[payee]+self.locked_in[payee]+amount > self.capacities[payee]:
+            reason = FAILED_INBOUND
+        else:
+            self.locked_out[payer] += amount
+            self.locked_in[payee] += amount
+            self._locks[invoice_id] = (payer, payee, amount, fee)
+            return True
+        for k, v in zip(("payer", "payee", "amount", "reason"), (payer, payee, amount, reason)):
+            self._failures[k].append(v)
+        return False
+
+    def _unlock(self, invoice_id: UUID) -> Tuple[int, int, int, int]:
+        self._invoices.pop(invoice_id, None)
+        lock = self._locks.pop(invoice_id, None)
+        if lock is not None:
+            payer, payee, amount, _ = lock
+            self.locked_out[payer] -= amount
+            self.locked_in[payee] -= amount
+        return lock
+
+    def settle(self, invoice_id: UUID) -> None:
+        lock = self._unlock(invoice_id)
+        if lock is None:
+            return
+        payer, payee, amount, fee = lock
+        self.balances[payer] -= amount
+        self.balances[payee] += amount
+        for k, v in zip(("payer", "payee", "amount", "fee"), lock):
+            self._transfers[k].append(v)
+
+    def cancel(self, invoice_id: UUID) -> None:
+        self._unlock(invoice_id)
+
+    def report(self) -> Dict[str, np.ndarray]:
+        n = len(self.node_names)
+        t = {k: np.frombuffer(v, dtype=np.int64) for k, v in self._transfers.items()}
+        f = {k: np.frombuffer(v, dtype=np.int64) for k, v in self._failures.items()}
+        outbound = f["reason"] == FAILED_OUTBOUND
+        return {
+            "balance": self.balances[:n].copy(),
+            "capacity": self.capacities[:n].copy(),
+            "paid": np.bincount(t["payer"], weights=t["amount"], minlength=n).astype(np.int64),
+            "received": np.bincount(t["payee"], weights=t["amount"], minlength=n).astype(np.int64),
+            "fees_earned": np.bincount(t["payee"], weights=t["fee"], minlength=n).astype(np.int64),
+            "payments": np.bincount(t["payer"], minlength=n),
+            "failed_outbound": np.bincount(f["payer"][outbound], minlength=n),
+            "failed_inbound": np.bincount(f["payee"][~outbound], minlength=n),
+        }
+
+    def print_report(self, only_active: bool = True) -> None:
+        report = self.report()
+        active = np.ones(len(self.node_names), dtype=bool)
+        if only_active:
+            active = (report["paid"] > 0) | (report["received"] > 0) | \
+                (report["failed_outbound"] > 0) | (report["failed_inbound"] > 0)
+        columns = list(report)
+        print(f"{'node':24}", " ".join(f"{k:>15}" for k in columns))
+        for node_id in np.flatnonzero(active):
+            print(f"{self.node_names[node_id]:24}", " ".join(f"{report[k][node_id]:15}" for k in columns))
+        print(f"{'total':24}", " ".join(f"{report[k].sum():15}" for k in columns))
@@ -1,17 +1,32 @@
 from __future__ import annotations
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from myrepr import ReprObject
+from canonical import CanonicalObject
 from crypto import compute_sha512, generate_symmetric_key
+from expiring import ExpiringDict
+from liquidity import LiquidityNetwork
+from collections import deque
 from collections.abc import Callable
+from contextlib import contextmanager
+from itertools import count
+from timeit import default_timer as timer
+from typing import Dict, Iterable, List, Tuple
 from uuid import UUID, uuid4
+import heapq
+
+# expired invoices are cancelled at most this many at a time, the rest wait for the next call
+INVOICE_CANCEL_BATCH_SIZE = 1024
+SETTLEMENT_LATENCY_HISTORY = 10000
+# chains whose first invoice is neither settled nor cancelled are forgotten after this long at most
+SETTLEMENT_CHAIN_TTL = timedelta(days=1)
 
 
 def compute_payment_hash(preimage: bytes) -> bytes:
     return compute_sha512([preimage])
 
 
-class HodlInvoice(ReprObject):
+class HodlInvoice(CanonicalObject):
     def __init__(self, payment_hash: bytes, amount: int,
                  on_accepted: Callable[[HodlInvoice]],
                  valid_till: datetime,
@@ -23,6 +38,7 @@ class HodlInvoice(ReprObject):
         self.valid_till = valid_till
         self.is_accepted = False
         self.is_settled = False
+        self.is_cancelled = False
         self.on_accepted = on_accepted
 
 
@@ -37,13 +53,199 @@ class Invoice(ReprObject):
         self.is_accepted = False
 
 
+class ChainSettlement(ReprObject):
+    def __init__(self, invoice_id: UUID, started: float) -> None:
+        self.invoice_id = invoice_id
+        self.started = started
+        self.hops = 0
+        self.latency = None
+
+
+class SettlementEngine:
+    """Runs invoice callbacks (on_accepted, on_settled) from a work queue instead of the stack.
+
+    Accepting an invoice of a route accepts the next one from inside its callback and settling
+    walks back the same way, so calling the callbacks directly nests two frames per hop. Here a
+    callback fired while the queue is being drained is appended to it, which keeps the stack flat
+    for routes of any length. Payments made from outside a callback start a chain; its hops and
+    the time until its first invoice is settled end up in `latencies`. When a callback raises, the
+    rest of its chain is dropped from the queue, the other chains still run and the error is
+    raised again once the queue is empty.
+    """
+
+    def __init__(self, latency_history: int = SETTLEMENT_LATENCY_HISTORY,
+                 chain_ttl: timedelta = SETTLEMENT_CHAIN_TTL) -> None:
+        self._queue = deque()
+        self._draining = False
+        self._batching = False
+        self._chain: ChainSettlement = None
+        self._chains: Dict[UUID, ChainSettlement] = ExpiringDict(chain_ttl)
+        self.latencies = deque(maxlen=latency_history)
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def _submit(self, chain: ChainSettlement, fn: Callable, args: tuple) -> None:
+        self._queue.append((chain, fn, args))
+        if not self._draining and not self._batching:
+            self.run()
+
+    def run(self) -> None:
+        if self._draining:
+            return
+        self._draining = True
+        error = None
+        try:
+            while self._queue:
+                self._chain, fn, args = self._queue.popleft()
+                try:
+                    fn(*args)
+                except Exception as e:
+                    self._drop_chain(self._chain)
+                    if error is None:
+                        error = e
+        finally:
+            self._chain = None
+            self._draining = False
+        if error is not None:
+            raise error
+
+    def _drop_chain(self, chain: ChainSettlement) -> None:
+        # callbacks outside of any chain are unrelated to each other, only a chain is dropped as a whole
+        if chain is None:
+            return
+        self._queue = deque(item for item in self._queue if item[0] is not chain)
+        self._chains.pop(chain.invoice_id, None)
+
+    @contextmanager
+    def batch(self):
+        # callbacks of the payments made inside run together, one chain step after the other
+        batching = self._batching
+        self._batching = True
+        try:
+            yield self
+        finally:
+            self._batching = batching
+            if not batching:
+                self.run()
+
+    def accept(self, invoice: HodlInvoice) -> None:
+        chain = self._chain
+        if chain is None:
+            chain = ChainSettlement(invoice.id, timer())
+            ttl = self._chains.ttl
+            if invoice.valid_till != datetime.max:
+                ttl = min(ttl, max(invoice.valid_till-datetime.now(), timedelta(0)))
+            self._chains.set(invoice.id, chain, ttl)
+        chain.hops += 1
+        self._submit(chain, invoice.on_accepted, (invoice,))
+
+    def settle(self, invoice: HodlInvoice, preimage: bytes) -> None:
+        chain = self._chains.pop(invoice.id, None)
+        if chain is not None:
+            chain.latency = timer()-chain.started
+            self.latencies.append(chain)
+        self._submit(self._chain, invoice.on_settled, (invoice, preimage))
+
+    def on_cancelled(self, invoice: HodlInvoice) -> None:
+        self._chains.pop(invoice.id, None)
+
+
+SETTLEMENT_ENGINE = SettlementEngine()
+
+
 class PaymentChannel(ReprObject):
+    """Creates and settles HODL invoices and keeps a ledger of the ones that are still open.
+
+    Open invoices are indexed by id and by payment hash. Invoices with a finite `valid_till`
+    are also pushed on a min-heap of expiries that drives cancel_expired_invoices; settled and
+    cancelled invoices are dropped from the indexes right away and from the heap lazily. An
+    invoice settled through another channel stays in the ledger until it expires.
+    """
+
+    def __init__(self, settlement_engine: SettlementEngine = SETTLEMENT_ENGINE,
+                 liquidity_network: LiquidityNetwork = None, node_id: int = None) -> None:
+        self._settlement_engine = settlement_engine
+        self._liquidity_network = liquidity_network
+        self.node_id = node_id
+        self._invoices_by_id: Dict[UUID, HodlInvoice] = dict()
+        self._invoices_by_payment_hash: Dict[bytes, Dict[UUID, HodlInvoice]] = dict()
+        self._expiry_heap: List[Tuple[datetime, int, HodlInvoice]] = list()
+        self._expiry_seq = count()
+
+    def __len__(self) -> int:
+        return len(self._invoices_by_id)
+
+    def _add_invoice(self, invoice: HodlInvoice) -> None:
+        self._invoices_by_id[invoice.id] = invoice
+        self._invoices_by_payment_hash.setdefault(invoice.payment_hash, dict())[invoice.id] = invoice
+        if invoice.valid_till != datetime.max:
+            heapq.heappush(self._expiry_heap, (invoice.valid_till, next(self._expiry_seq), invoice))
+
+    def _remove_invoice(self, invoice: HodlInvoice) -> None:
+        if self._invoices_by_id.get(invoice.id) is not invoice:
+            return
+        del self._invoices_by_id[invoice.id]
+        by_hash = self._invoices_by_payment_hash[invoice.payment_hash]
+        del by_hash[invoice.id]
+        if not by_hash:
+            del self._invoices_by_payment_hash[invoice.payment_hash]
+
+    def _compact_expiry_heap(self) -> None:
+        # invoices closed before they expire leave dead heap entries behind, rebuild before they dominate it
+        if len(self._expiry_heap) > 2*len(self._invoices_by_id)+INVOICE_CANCEL_BATCH_SIZE:
+            self._expiry_heap = [entry for entry in self._expiry_heap
+                                 if self._invoices_by_id.get(entry[2].id) is entry[2]]
+            heapq.heapify(self._expiry_heap)
+
+    def get_invoice(self, invoice_id: UUID) -> HodlInvoice:
+        return self._invoices_by_id.get(invoice_id)
+
+    def get_invoices_by_payment_hash(self, payment_hash: bytes) -> List[HodlInvoice]:
+        return list(self._invoices_by_payment_hash.get(payment_hash, dict()).values())
+
+    def cancel_hodl_invoice(self, invoice: HodlInvoice) -> None:
+        if invoice.is_settled or invoice.is_cancelled:
+            return
+        invoice.is_cancelled = True
+        self._remove_invoice(invoice)
+        self._compact_expiry_heap()
+        self._settlement_engine.on_cancelled(invoice)
+        if self._liquidity_network is not None:
+            self._liquidity_network.cancel(invoice.id)
+
+    def cancel_expired_invoices(self, now: datetime = None,
+                                max_batch: int = INVOICE_CANCEL_BATCH_SIZE) -> List[HodlInvoice]:
+        now = datetime.now() if now is None else now
+        heap = self._expiry_heap
+        cancelled = list()
+        while heap and heap[0][0] < now and len(cancelled) < max_batch:
+            _, _, invoice = heapq.heappop(heap)
+            if self._invoices_by_id.get(invoice.id) is not invoice:
+                continue
+            self._remove_invoice(invoice)
+            # settled through another channel, nothing to cancel
+            if invoice.is_settled:
+                continue
+            invoice.is_cancelled = True
+            self._settlement_engine.on_cancelled(invoice)
+            if self._liquidity_network is not None:
+                self._liquidity_network.cancel(invoice.id)
+            cancelled.append(invoice)
+        return cancelled
+
     def create_hodl_invoice(self, amount: int, payment_hash: bytes,
                             on_accepted: Callable[[HodlInvoice]],
                             valid_till: datetime = datetime.max,
                             invoice_id: UUID = None,
+                            routing_fee: int = 0,
                             ) -> HodlInvoice:
-        return HodlInvoice(payment_hash, amount, on_accepted, valid_till, invoice_id)
+        self.cancel_expired_invoices()
+        invoice = HodlInvoice(payment_hash, amount, on_accepted, valid_till, invoice_id)
+        self._add_invoice(invoice)
+        if self._liquidity_network is not None:
+            self._liquidity_network.open_invoice(invoice.id, self.node_id, routing_fee)
+        return invoice
 
     def create_invoice(self, amount: int, preimage: bytes,
                        valid_till: datetime = datetime.max,
@@ -51,20 +253,33 @@ class PaymentChannel(ReprObject):
         return Invoice(preimage, amount, valid_till)
 
     def pay_hodl_invoice(self, invoice: HodlInvoice, on_settled: Callable[[HodlInvoice, bytes]]) -> None:
-        if invoice.is_accepted:
+        if invoice.is_accepted or invoice.is_cancelled:
             return
         if datetime.now() > invoice.valid_till:
             return
 
+        if self._liquidity_network is not None \
+                and not self._liquidity_network.lock(invoice.id, self.node_id, invoice.amount):
+            return
+
         invoice.on_settled = on_settled
         invoice.is_accepted = True
-        invoice.on_accepted(invoice)
+        self._settlement_engine.accept(invoice)
+
+    def pay_hodl_invoices(self, payments: Iterable[Tuple[HodlInvoice, Callable[[HodlInvoice, bytes]]]]) -> None:
+        with self._settlement_engine.batch():
+            for invoice, on_settled in payments:
+                self.pay_hodl_invoice(invoice, on_settled)
 
     def settle_hodl_invoice(self, invoice: HodlInvoice, preimage: bytes) -> None:
-        if invoice.is_settled:
+        if invoice.is_settled or invoice.is_cancelled:
             return
         if invoice.is_accepted:
             if compute_payment_hash(preimage) == invoice.payment_hash:
                 invoice.preimage = preimage
                 invoice.is_settled = True
-                invoice.on_settled(invoice, preimage)
+                self._remove_invoice(invoice)
+                self._compact_expiry_heap()
+                if self._liquidity_network is not None:
+                    self._liquidity_network.settle(invoice.id)
+                self._settlement_engine.settle(invoice, preimage)
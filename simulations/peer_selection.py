@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from typing import List
+import random
+
+import pygeohash as pgh
+
+from subscriptions import summary_covers
+
+# Strategies that pick which peers a SweetGossipNode asks to forward a broadcast to. `peers`
+# never contains the peer the broadcast came from.
+
+DEFAULT_FANOUT = 2
+
+
+class PeerSelectionStrategy:
+    name = "abstract"
+
+    def select(self, node, request_payload, peers: List) -> List:
+        raise NotImplementedError()
+
+
+class FloodStrategy(PeerSelectionStrategy):
+    name = "flood"
+
+    def select(self, node, request_payload, peers: List) -> List:
+        return peers
+
+
+class RandomKStrategy(PeerSelectionStrategy):
+    name = "random-k"
+
+    def __init__(self, k: int = DEFAULT_FANOUT, rng: random.Random = None) -> None:
+        self.k = k
+        self.rng = random if rng is None else rng
+
+    def select(self, node, request_payload, peers: List) -> List:
+        if len(peers) <= self.k:
+            return peers
+        return self.rng.sample(peers, self.k)
+
+
+class DegreeWeightedStrategy(PeerSelectionStrategy):
+    """k peers drawn without replacement with probability proportional to their own degree."""
+    name = "degree-weighted"
+
+    def __init__(self, k: int = DEFAULT_FANOUT, rng: random.Random = None) -> None:
+        self.k = k
+        self.rng = random if rng is None else rng
+
+    def select(self, node, request_payload, peers: List) -> List:
+        if len(peers) <= self.k:
+            return peers
+        # weighted sampling without replacement: the k largest u^(1/w) keys
+        keyed = [(self.rng.random()**(1/max(1, peer.degree())), i) for i, peer in enumerate(peers)]
+        keyed.sort(reverse=True)
+        return [peers[i] for _, i in keyed[:self.k]]
+
+
+class GeohashProximityStrategy(PeerSelectionStrategy):
+    """k peers closest to the `from_geohash` of the topic, by the `geohash` attribute of the peer.
+
+    Topics without a geohash and peers without one fall back to flooding and to being picked last.
+    """
+    name = "geohash"
+
+    def __init__(self, k: int = DEFAULT_FANOUT) -> None:
+        self.k = k
+
+    def select(self, node, request_payload, peers: List) -> List:
+        target = getattr(request_payload.topic, "from_geohash", None)
+        if target is None or len(peers) <= self.k:
+            return peers
+
+        def distance(peer):
+            geohash = getattr(peer, "geohash", None)
+            if geohash is None:
+                return float("inf")
+            return pgh.geohash_haversine_distance(geohash, target)
+
+        return sorted(peers, key=distance)[:self.k]
+
+
+class SubscriptionSummaryStrategy(PeerSelectionStrategy):
+    """Peers whose advertised subscription summary covers the `from_geohash` of the topic, that is
+    peers with a subscriber of the area at most SUMMARY_RADIUS hops behind them. When no peer
+    covers it the broadcast is not near any subscriber yet and `fallback` picks the peers."""
+    name = "subscriptions"
+
+    def __init__(self, fallback: PeerSelectionStrategy = None) -> None:
+        self.fallback = RandomKStrategy() if fallback is None else fallback
+
+    def select(self, node, request_payload, peers: List) -> List:
+        target = getattr(request_payload.topic, "from_geohash", None)
+        if target is None:
+            return self.fallback.select(node, request_payload, peers)
+        covering = [peer for peer in peers if summary_covers(node.peer_subscription_summary(peer.name), target)]
+        if covering:
+            return covering
+        return self.fallback.select(node, request_payload, peers)
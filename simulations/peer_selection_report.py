@@ -0,0 +1,50 @@
+# %%
+import argparse
+import contextlib
+import io
+import random
+import sys
+
+import complex_sim
+from experiment_tools import RANDOM_SEED
+from peer_selection import (DEFAULT_FANOUT, DegreeWeightedStrategy, FloodStrategy,
+                            GeohashProximityStrategy, RandomKStrategy, SubscriptionSummaryStrategy)
+
+
+def strategies(k=DEFAULT_FANOUT):
+    return [FloodStrategy(), RandomKStrategy(k), DegreeWeightedStrategy(k), GeohashProximityStrategy(k),
+            SubscriptionSummaryStrategy(RandomKStrategy(k))]
+
+
+def compare_peer_selection(k=DEFAULT_FANOUT, crypto_suite=complex_sim.CRYPTO_SUITE, keystore_dir=complex_sim.KEYSTORE_DIR):
+    results = dict()
+    for strategy in strategies(k):
+        # same customers and gig workers for every strategy
+        random.seed(RANDOM_SEED)
+        stats = dict()
+        with contextlib.redirect_stdout(io.StringIO()):
+            complex_sim.main(sim_id=strategy.name, crypto_suite=crypto_suite, keystore_dir=keystore_dir,
+                             peer_selection=strategy, stats=stats)
+        results[strategy.name] = stats
+
+    print(f"{'strategy':16} {'delivery':>9} {'messages':>9} {'replied':>8} {'first reply':>12}")
+    for name, r in results.items():
+        first_reply = "-" if r["mean_time_to_first_reply"] is None else f"{r['mean_time_to_first_reply']:10.2f} s"
+        print(f"{name:16} {r['delivery_ratio']:9.2f} {r['messages']:9} "
+              f"{r['customers_with_reply']:>4}/{r['customers']:<3} {first_reply:>12}")
+    return results
+
+
+# %%
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="compare gossip peer selection strategies on the complex_sim grid")
+    parser.add_argument("--k", type=int, default=DEFAULT_FANOUT, help="fan-out of the non flooding strategies")
+    parser.add_argument("--crypto-suite", default=complex_sim.CRYPTO_SUITE)
+    parser.add_argument("--keystore-dir", default=complex_sim.KEYSTORE_DIR)
+    args = parser.parse_args(argv)
+    compare_peer_selection(args.k, args.crypto_suite, args.keystore_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
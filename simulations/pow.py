@@ -1,8 +1,26 @@
-import crypto
-import pickle
-import sys
+from __future__ import annotations
+
+import canonical
+import hashlib
+import multiprocessing
+import os
+import queue
+from datetime import datetime
 
 from myrepr import ReprObject
+from stopwatch import Stopwatch
+
+NUANCE_LIMIT = 1 << 32
+POW_MAX_WORKERS = os.cpu_count() or 1
+# below this many expected hashes starting worker processes costs more than it saves
+POW_PARALLEL_MIN_HASHES = 1 << 17
+# nonces are tried in batches of this size, the deadline and the stop event are checked between batches
+POW_BATCH_SIZE = 1 << 12
+CALIBRATION_SECONDS = 0.5
+CALIBRATION_PAYLOAD_SIZE = 1024
+
+# hashes per second of a single solver process on this machine, by scheme; filled by calibrate_pow
+POW_HASH_RATE = dict()
 
 MAX_POW_TARGET_SHA256 = int.from_bytes(
     b'\x0F\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF', 'big')
@@ -16,34 +34,144 @@ def pow_target_from_complexity(pow_scheme: str, complexity: int) -> int:
     raise NotImplementedError()
 
 
+def _pow_buffer(obj, pow_scheme: str, pow_target: int) -> bytes:
+    # the work covers a fixed size digest of obj, so its cost does not depend on the size of obj
+    return canonical.digest(obj)+pow_target.to_bytes(32, "big")+pow_scheme.lower().encode("ascii")
+
+
 def _validate_sha25_pow(buf: bytes, nuance: int, pow_target: int) -> bool:
     if pow_target==0:
         return True
 
-    return int.from_bytes(crypto.compute_sha256([
-        buf,
-        nuance.to_bytes(4, "big")
-    ]), "big") <= pow_target
+    return int.from_bytes(hashlib.sha256(buf+nuance.to_bytes(4, "big")).digest(), "big") <= pow_target
 
 
 def validate_pow(obj, nuance: int, pow_scheme: str, pow_target: int) -> bool:
     if pow_scheme.lower() == "sha256":
-        buf = bytearray(pickle.dumps(obj))
+        buf = _pow_buffer(obj, pow_scheme, pow_target)
         return _validate_sha25_pow(buf, nuance, pow_target)
     return False
 
 
-def compute_pow(obj, pow_scheme: str, pow_target: int) -> int:
+def _sha256_pow_batch(prefix, target: bytes, nuances: range) -> int:
+    copy = prefix.copy
+    for nuance in nuances:
+        h = copy()
+        h.update(nuance.to_bytes(4, "big"))
+        # equal length big endian digests compare like the integers they encode
+        if h.digest() <= target:
+            return nuance
+    return None
+
+
+def _search_sha256_pow(buf: bytes, pow_target: int, start: int, step: int,
+                       deadline: datetime = None, stop_event=None) -> int:
+    # the buffer is hashed once, every nonce continues from a copy of that midstate
+    prefix = hashlib.sha256(buf)
+    target = min(pow_target, (1 << 256)-1).to_bytes(32, "big")
+    batch = POW_BATCH_SIZE*step
+    for batch_start in range(start, NUANCE_LIMIT, batch):
+        nuance = _sha256_pow_batch(prefix, target, range(batch_start, min(batch_start+batch, NUANCE_LIMIT), step))
+        if nuance is not None:
+            return nuance
+        if stop_event is not None and stop_event.is_set():
+            return None
+        if deadline is not None and datetime.now() > deadline:
+            return None
+    return None
+
+
+def _pow_worker(buf: bytes, pow_target: int, start: int, step: int, deadline: datetime, stop_event, results) -> None:
+    results.put(_search_sha256_pow(buf, pow_target, start, step, deadline, stop_event))
+
+
+def _search_sha256_pow_parallel(buf: bytes, pow_target: int, workers: int, deadline: datetime = None) -> int:
+    # worker i tries nonces i, i+workers, ...; the first solution stops all of them
+    ctx = multiprocessing.get_context()
+    stop_event = ctx.Event()
+    results = ctx.Queue()
+    processes = [ctx.Process(target=_pow_worker, args=(buf, pow_target, i, workers, deadline, stop_event, results), daemon=True)
+                 for i in range(workers)]
+    for p in processes:
+        p.start()
+    nuance = None
+    try:
+        for _ in range(workers):
+            timeout = None if deadline is None else max(0, (deadline-datetime.now()).total_seconds())+1
+            try:
+                nuance = results.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if nuance is not None:
+                break
+    finally:
+        stop_event.set()
+        for p in processes:
+            p.join(timeout=1)
+            if p.is_alive():
+                p.terminate()
+    return nuance
+
+
+def compute_pow(obj, pow_scheme: str, pow_target: int, deadline: datetime = None, max_workers: int = None) -> int:
     if pow_target==0:
         return 0
     if pow_scheme.lower() == "sha256":
-        buf = bytearray(pickle.dumps(obj))
-        for nuance in range(sys.maxsize):
-            if _validate_sha25_pow(buf, nuance, pow_target):
-                return nuance
+        buf = _pow_buffer(obj, pow_scheme, pow_target)
+        workers = POW_MAX_WORKERS if max_workers is None else max_workers
+        if workers > 1 and expected_hashes(pow_target) >= POW_PARALLEL_MIN_HASHES:
+            return _search_sha256_pow_parallel(buf, pow_target, workers, deadline)
+        return _search_sha256_pow(buf, pow_target, 0, 1, deadline)
     return None
 
 
+def expected_hashes(pow_target: int) -> int:
+    if pow_target==0:
+        return 0
+    return (1 << 256)//(pow_target+1)
+
+
+def measure_hash_rate(pow_scheme: str, seconds: float = CALIBRATION_SECONDS,
+                      payload_size: int = CALIBRATION_PAYLOAD_SIZE) -> float:
+    if pow_scheme.lower() == "sha256":
+        prefix = hashlib.sha256(os.urandom(payload_size))
+        # no digest is below a target of 1, so every batch is searched to the end
+        target = (1).to_bytes(32, "big")
+        hashes = 0
+        with Stopwatch() as sw:
+            while sw.elapsed < seconds:
+                _sha256_pow_batch(prefix, target, range(hashes, hashes+POW_BATCH_SIZE))
+                hashes += POW_BATCH_SIZE
+        return hashes/sw.total
+    raise NotImplementedError()
+
+
+def calibrate_pow(pow_scheme: str, seconds: float = CALIBRATION_SECONDS, force: bool = False) -> float:
+    global POW_HASH_RATE
+    scheme = pow_scheme.lower()
+    if force or scheme not in POW_HASH_RATE:
+        POW_HASH_RATE[scheme] = measure_hash_rate(scheme, seconds)
+    return POW_HASH_RATE[scheme]
+
+
+def expected_time_from_complexity(pow_scheme: str, complexity: int, hash_rate: float = None) -> float:
+    if hash_rate is None:
+        hash_rate = calibrate_pow(pow_scheme)
+    return expected_hashes(pow_target_from_complexity(pow_scheme, complexity))/hash_rate
+
+
+def complexity_for_expected_time(pow_scheme: str, seconds: float, hash_rate: float = None) -> int:
+    """Complexity whose expected solving time by one process on this machine is closest to `seconds`."""
+    if seconds <= 0:
+        return 0
+    if hash_rate is None:
+        hash_rate = calibrate_pow(pow_scheme)
+    if pow_scheme.lower() == "sha256":
+        # expected_hashes(MAX_POW_TARGET_SHA256//complexity) grows linearly with the complexity
+        return max(1, round(seconds*hash_rate*(MAX_POW_TARGET_SHA256+1)/(1 << 256)))
+    raise NotImplementedError()
+
+
 class ProofOfWork(ReprObject):
     def __init__(self, pow_scheme: str, pow_target: int, nuance: int) -> None:
         self.pow_scheme = pow_scheme
@@ -51,8 +179,7 @@ class ProofOfWork(ReprObject):
         self.nuance = nuance
 
     def validate(self, obj) -> bool:
-        row = (obj, self.pow_scheme, self.pow_target)
-        return validate_pow(row, self.nuance, self.pow_scheme, self.pow_target)
+        return validate_pow(obj, self.nuance, self.pow_scheme, self.pow_target)
 
 
 class WorkRequest(ReprObject):
@@ -60,8 +187,16 @@ class WorkRequest(ReprObject):
         self.pow_scheme = pow_scheme
         self.pow_target = pow_target
 
-    def compute_proof(self, obj) -> ProofOfWork:
-        row = (obj, self.pow_scheme, self.pow_target)
+    def compute_proof(self, obj, deadline: datetime = None) -> ProofOfWork:
         return ProofOfWork(
             self.pow_scheme, self.pow_target,
-            compute_pow(row, self.pow_scheme, self.pow_target))
+            compute_pow(obj, self.pow_scheme, self.pow_target, deadline))
+
+    @classmethod
+    def for_expected_time(cls, seconds: float, pow_scheme: str = "sha256", hash_rate: float = None) -> WorkRequest:
+        return cls(pow_scheme, pow_target_from_complexity(
+            pow_scheme, complexity_for_expected_time(pow_scheme, seconds, hash_rate)))
+
+    @property
+    def expected_hashes(self) -> int:
+        return expected_hashes(self.pow_target)
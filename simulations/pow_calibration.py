@@ -0,0 +1,41 @@
+# %%
+import argparse
+import sys
+
+import pow
+
+COMPLEXITIES = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+EXPECTED_SECONDS = (0.01, 0.1, 1, 10, 60)
+
+
+def print_calibration_table(pow_scheme="sha256", complexities=COMPLEXITIES, expected_seconds=EXPECTED_SECONDS,
+                            seconds=pow.CALIBRATION_SECONDS, workers=1):
+    hash_rate = pow.calibrate_pow(pow_scheme, seconds, force=True)*workers
+    print(f"{pow_scheme}: {hash_rate:.1f} hashes/s with {workers} worker(s)")
+    print(f"{'complexity':>12} {'expected hashes':>16} {'expected latency':>18}")
+    for complexity in complexities:
+        target = pow.pow_target_from_complexity(pow_scheme, complexity)
+        print(f"{complexity:12} {pow.expected_hashes(target):16} "
+              f"{pow.expected_time_from_complexity(pow_scheme, complexity, hash_rate):16.4f} s")
+    print(f"{'latency':>12} {'complexity':>16}")
+    for s in expected_seconds:
+        print(f"{s:10.2f} s {pow.complexity_for_expected_time(pow_scheme, s, hash_rate):16}")
+    return hash_rate
+
+
+# %%
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="measure the PoW hash rate and print the complexity to latency table")
+    parser.add_argument("--scheme", default="sha256", help="pow scheme")
+    parser.add_argument("--seconds", type=float, default=pow.CALIBRATION_SECONDS, help="time spent measuring the hash rate")
+    parser.add_argument("--workers", type=int, default=1, help="assume this many solver processes")
+    parser.add_argument("--complexities", type=int, nargs="+", default=list(COMPLEXITIES))
+    parser.add_argument("--latencies", type=float, nargs="+", default=list(EXPECTED_SECONDS),
+                        help="expected solving times to find the complexity for")
+    args = parser.parse_args(argv)
+    print_calibration_table(args.scheme, args.complexities, args.latencies, args.seconds, args.workers)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
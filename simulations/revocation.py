@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+from math import ceil, log
+from typing import Callable, List, Set
+
+from myrepr import ReprObject
+
+# Certificates are revoked by fingerprint (see cert.Certificate.fingerprint). Fingerprints are
+# SHA-256 digests, so Bloom filter bit positions are taken straight from their bytes.
+
+
+class BloomFilter(ReprObject):
+    def __init__(self, num_bits: int, num_hashes: int, bits: bytes = None) -> None:
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray((num_bits+7)//8) if bits is None else bytearray(bits)
+
+    @classmethod
+    def with_capacity(cls, capacity: int, false_positive_rate: float = 0.001) -> BloomFilter:
+        capacity = max(capacity, 1)
+        num_bits = ceil(-capacity*log(false_positive_rate)/(log(2)**2))
+        num_hashes = max(1, round(num_bits/capacity*log(2)))
+        return cls(num_bits, num_hashes)
+
+    def _positions(self, fingerprint: bytes):
+        h1 = int.from_bytes(fingerprint[:8], "big")
+        h2 = int.from_bytes(fingerprint[8:16], "big") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i*h2) % self.num_bits
+
+    def add(self, fingerprint: bytes) -> None:
+        for p in self._positions(fingerprint):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, fingerprint: bytes) -> bool:
+        bits = self.bits
+        for p in self._positions(fingerprint):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+
+class RevocationSnapshot(ReprObject):
+    def __init__(self, ca_name: str, version: int, bloom_filter: BloomFilter) -> None:
+        self.ca_name = ca_name
+        self.version = version
+        self.bloom_filter = bloom_filter
+
+
+class RevocationDelta(ReprObject):
+    def __init__(self, ca_name: str, base_version: int, fingerprints: List[bytes]) -> None:
+        self.ca_name = ca_name
+        self.base_version = base_version
+        self.fingerprints = fingerprints
+
+    @property
+    def version(self) -> int:
+        return self.base_version+len(self.fingerprints)
+
+
+class RevocationStore:
+    """Authoritative revocation index of a CA.
+
+    Lookups are a set membership test. Revocations are also appended to a log, the version is
+    the log length, so a delta is the slice of the log after the version a node already has.
+    """
+
+    def __init__(self, ca_name: str) -> None:
+        self.ca_name = ca_name
+        self._revoked: Set[bytes] = set()
+        self._log: List[bytes] = list()
+
+    @property
+    def version(self) -> int:
+        return len(self._log)
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+    def revoke(self, fingerprint: bytes) -> bool:
+        if fingerprint in self._revoked:
+            return False
+        self._revoked.add(fingerprint)
+        self._log.append(fingerprint)
+        return True
+
+    def is_revoked(self, fingerprint: bytes) -> bool:
+        return fingerprint in self._revoked
+
+    def snapshot(self, false_positive_rate: float = 0.001, headroom: float = 2.0) -> RevocationSnapshot:
+        bloom_filter = BloomFilter.with_capacity(
+            int(len(self._log)*headroom), false_positive_rate)
+        for fingerprint in self._log:
+            bloom_filter.add(fingerprint)
+        return RevocationSnapshot(self.ca_name, self.version, bloom_filter)
+
+    def delta_since(self, version: int) -> RevocationDelta:
+        return RevocationDelta(self.ca_name, version, self._log[version:])
+
+
+class RevocationView:
+    """What a node knows about the revocations of one CA: a received snapshot plus deltas.
+
+    A Bloom filter hit is only "possibly revoked"; it is passed to `confirm` (e.g. a query to
+    the CA) when one is given and is otherwise treated as revoked.
+    """
+
+    def __init__(self, snapshot: RevocationSnapshot, confirm: Callable[[bytes], bool] = None) -> None:
+        self.ca_name = snapshot.ca_name
+        self.version = snapshot.version
+        self._bloom_filter = snapshot.bloom_filter
+        self._confirm = confirm
+
+    def apply_delta(self, delta: RevocationDelta) -> bool:
+        if delta.ca_name != self.ca_name or delta.base_version > self.version:
+            return False
+        for fingerprint in delta.fingerprints[self.version-delta.base_version:]:
+            self._bloom_filter.add(fingerprint)
+        self.version = max(self.version, delta.version)
+        return True
+
+    def is_revoked(self, fingerprint: bytes) -> bool:
+        if fingerprint not in self._bloom_filter:
+            return False
+        if self._confirm is None:
+            return True
+        return self._confirm(fingerprint)
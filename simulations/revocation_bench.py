@@ -0,0 +1,53 @@
+# %%
+import os
+import pickle
+import sys
+from datetime import datetime, timedelta
+
+import crypto
+from cert import create_certification_authority
+from crypto_bench import measure
+from revocation import RevocationView
+
+REVOKED_ENTRIES = 1_000_000
+BENCH_SECONDS = 1.0
+
+
+def bench_revocation(revoked_entries=REVOKED_ENTRIES, seconds=BENCH_SECONDS):
+    ca = create_certification_authority("RevocationBenchCA", "x25519")
+    _, public_key = crypto.generate_asymetric_keys("x25519")
+    certificate = ca.issue_certificate(public_key, "is_ok", True,
+                                       not_valid_after=datetime.now()+timedelta(days=7),
+                                       not_valid_before=datetime.now()-timedelta(days=7))
+    fingerprint = certificate.fingerprint()
+    certificate.verify()
+
+    results = dict()
+    results["verify (cached) @0"] = measure(certificate.verify, seconds)
+    results["is_revoked @0"] = measure(lambda: ca.revocations.is_revoked(fingerprint), seconds)
+
+    for _ in range(revoked_entries):
+        ca.revocations.revoke(os.urandom(32))
+
+    results[f"verify (cached) @{revoked_entries}"] = measure(certificate.verify, seconds)
+    results[f"is_revoked @{revoked_entries}"] = measure(lambda: ca.revocations.is_revoked(fingerprint), seconds)
+
+    snapshot = ca.revocation_snapshot()
+    view = RevocationView(snapshot)
+    results[f"bloom is_revoked @{revoked_entries}"] = measure(lambda: view.is_revoked(fingerprint), seconds)
+
+    for _ in range(1000):
+        ca.revocations.revoke(os.urandom(32))
+    delta = ca.revocation_delta(view.version)
+    results["apply_delta x1000"] = measure(lambda: RevocationView(snapshot).apply_delta(delta), seconds, min_samples=1)
+
+    for name, r in results.items():
+        print(f"{name:32} {r['ops_per_sec']:12.1f} ops/s  p50={r['p50_us']:8.2f}us  p99={r['p99_us']:8.2f}us")
+    print(f"snapshot {len(pickle.dumps(snapshot))/1e6:.2f} MB for {snapshot.version} entries, "
+          f"delta {len(pickle.dumps(delta))/1e3:.1f} kB for {len(delta.fingerprints)} entries")
+    return results
+
+
+# %%
+if __name__ == "__main__":
+    bench_revocation(int(sys.argv[1]) if len(sys.argv) > 1 else REVOKED_ENTRIES)
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from itertools import count
+from typing import Dict, List, Tuple
+from uuid import UUID, uuid4
+from weakref import WeakValueDictionary
+import heapq
+import sqlite3
+
+from payments import PaymentChannel
+
+SETTLEMENT_TTL = timedelta(days=1)
+# expired entries are evicted at most this many at a time, the rest wait for the next call
+SETTLEMENT_EVICT_BATCH_SIZE = 1024
+# open stores by id, so callbacks of pickled invoices can refer to their store without carrying it
+SETTLEMENT_STORES: WeakValueDictionary[UUID, SettlementStore] = WeakValueDictionary()
+
+
+def _sql_time(t: datetime) -> str:
+    # fixed width so that the text columns compare like the datetimes
+    return t.isoformat(timespec="microseconds")
+
+
+class SettlementStore:
+    """Preimages a settler holds for reply invoices, keyed by invoice id.
+
+    An entry lives until its invoice is settled or expires (`valid_till`, or `ttl` from now when
+    the invoice has no expiry). When `path` is given the entries are also written to an SQLite
+    file, so a restarted settler still settles the invoices that were in flight; entries loaded
+    from the file are settled through `payment_channel`, which is required with `path`.
+    """
+
+    def __init__(self, path: str = None, payment_channel: PaymentChannel = None,
+                 ttl: timedelta = SETTLEMENT_TTL) -> None:
+        if path is not None and payment_channel is None:
+            raise ValueError("a persistent settlement store needs a payment channel to settle reloaded entries")
+        self.id = uuid4()
+        SETTLEMENT_STORES[self.id] = self
+        self.path = path
+        self.payment_channel = payment_channel
+        self.ttl = ttl
+        self._entries: Dict[UUID, Tuple[PaymentChannel, bytes, datetime]] = dict()
+        self._expiry_heap: List[Tuple[datetime, int, UUID]] = list()
+        self._expiry_seq = count()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS settlements "
+                             "(invoice_id BLOB PRIMARY KEY, preimage BLOB NOT NULL, valid_till TEXT NOT NULL)")
+            self._db.commit()
+            for invoice_id, preimage, valid_till in self._db.execute("SELECT invoice_id, preimage, valid_till FROM settlements"):
+                self._put(UUID(bytes=invoice_id), None, preimage, datetime.fromisoformat(valid_till))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, invoice_id: UUID) -> bool:
+        return invoice_id in self._entries
+
+    def _put(self, invoice_id: UUID, payment_channel: PaymentChannel, preimage: bytes, valid_till: datetime) -> None:
+        self._entries[invoice_id] = (payment_channel, preimage, valid_till)
+        heapq.heappush(self._expiry_heap, (valid_till, next(self._expiry_seq), invoice_id))
+
+    def put(self, invoice_id: UUID, payment_channel: PaymentChannel, preimage: bytes, valid_till: datetime = None) -> None:
+        if valid_till is None or valid_till == datetime.max:
+            valid_till = datetime.now()+self.ttl
+        self.evict_expired()
+        self._put(invoice_id, payment_channel, preimage, valid_till)
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO settlements VALUES (?, ?, ?)",
+                             (invoice_id.bytes, preimage, _sql_time(valid_till)))
+            self._db.commit()
+
+    def get(self, invoice_id: UUID) -> Tuple[PaymentChannel, bytes]:
+        entry = self._entries.get(invoice_id)
+        if entry is None or entry[2] < datetime.now():
+            return None
+        payment_channel, preimage, _ = entry
+        return (self.payment_channel if payment_channel is None else payment_channel), preimage
+
+    def remove(self, invoice_id: UUID) -> None:
+        if self._entries.pop(invoice_id, None) is None:
+            return
+        if self._db is not None:
+            self._db.execute("DELETE FROM settlements WHERE invoice_id = ?", (invoice_id.bytes,))
+            self._db.commit()
+        # removed entries leave dead heap entries behind, rebuild before they dominate it
+        if len(self._expiry_heap) > 2*len(self._entries)+SETTLEMENT_EVICT_BATCH_SIZE:
+            self._expiry_heap = [entry for entry in self._expiry_heap
+                                 if entry[2] in self._entries and self._entries[entry[2]][2] == entry[0]]
+            heapq.heapify(self._expiry_heap)
+
+    def evict_expired(self, now: datetime = None, max_batch: int = SETTLEMENT_EVICT_BATCH_SIZE) -> int:
+        now = datetime.now() if now is None else now
+        heap = self._expiry_heap
+        evicted = list()
+        while heap and heap[0][0] < now and len(evicted) < max_batch:
+            valid_till, _, invoice_id = heapq.heappop(heap)
+            entry = self._entries.get(invoice_id)
+            # skip entries that were removed or put again with another expiry
+            if entry is None or entry[2] != valid_till:
+                continue
+            del self._entries[invoice_id]
+            evicted.append(invoice_id)
+        if evicted and self._db is not None:
+            self._db.executemany("DELETE FROM settlements WHERE invoice_id = ?",
+                                 [(invoice_id.bytes,) for invoice_id in evicted])
+            self._db.commit()
+        return len(evicted)
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def get_settlement_store(store_id: UUID) -> SettlementStore:
+    return SETTLEMENT_STORES.get(store_id)
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Dict, FrozenSet, Iterable, List
+
+from myrepr import ReprObject
+
+# neighbour summaries keep subscription areas only down to this many geohash characters
+SUMMARY_PRECISION = 5
+# subscriptions are advertised to the nodes at most this many hops away from the subscriber
+SUMMARY_RADIUS = 4
+
+
+class Subscription(ReprObject):
+    def __init__(self, subscriber: str, geohash: str,
+                 not_before: datetime = datetime.min, not_after: datetime = datetime.max) -> None:
+        self.subscriber = subscriber
+        self.geohash = geohash
+        self.not_before = not_before
+        self.not_after = not_after
+
+    def overlaps(self, start: datetime, end: datetime) -> bool:
+        return self.not_before <= end and start <= self.not_after
+
+
+class _TrieNode:
+    __slots__ = ("children", "subscriptions")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, _TrieNode] = dict()
+        self.subscriptions: List[Subscription] = list()
+
+
+class SubscriptionIndex:
+    """Subscriptions to geohash areas kept in a prefix trie.
+
+    A subscription to area "ezs4" is stored at the node of that prefix, so the subscriptions
+    matching a point are the ones met on the way from the root along its geohash: a lookup
+    walks at most len(geohash) nodes however many subscriptions there are.
+    """
+
+    def __init__(self) -> None:
+        self._root = _TrieNode()
+        self._count = 0
+        self._summaries: Dict[int, FrozenSet[str]] = dict()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def subscribe(self, subscription: Subscription) -> None:
+        node = self._root
+        for c in subscription.geohash:
+            node = node.children.setdefault(c, _TrieNode())
+        node.subscriptions.append(subscription)
+        self._count += 1
+        self._summaries.clear()
+
+    def unsubscribe(self, subscription: Subscription) -> bool:
+        path = [self._root]
+        for c in subscription.geohash:
+            node = path[-1].children.get(c)
+            if node is None:
+                return False
+            path.append(node)
+        if subscription not in path[-1].subscriptions:
+            return False
+        path[-1].subscriptions.remove(subscription)
+        # drop the nodes left without subscriptions and children
+        for parent, c, node in zip(reversed(path[:-1]), reversed(subscription.geohash), reversed(path[1:])):
+            if node.subscriptions or node.children:
+                break
+            del parent.children[c]
+        self._count -= 1
+        self._summaries.clear()
+        return True
+
+    def match_geohash(self, geohash: str, start: datetime = datetime.min, end: datetime = datetime.max) -> List[Subscription]:
+        node = self._root
+        matches = [s for s in node.subscriptions if s.overlaps(start, end)]
+        for c in geohash:
+            node = node.children.get(c)
+            if node is None:
+                break
+            matches.extend(s for s in node.subscriptions if s.overlaps(start, end))
+        return matches
+
+    def match(self, topic) -> List[Subscription]:
+        geohash = getattr(topic, "from_geohash", None)
+        if geohash is None:
+            return list()
+        return self.match_geohash(geohash,
+                                  getattr(topic, "pickup_after", datetime.min),
+                                  getattr(topic, "dropoff_before", datetime.max))
+
+    def summary(self, precision: int = SUMMARY_PRECISION) -> FrozenSet[str]:
+        """Areas of all subscriptions cut to `precision` characters, what a node tells its neighbours."""
+        if precision not in self._summaries:
+            areas = set()
+            stack = [(self._root, "")]
+            while stack:
+                node, prefix = stack.pop()
+                if node.subscriptions or len(prefix) == precision:
+                    # everything below is covered by this prefix
+                    areas.add(prefix)
+                    continue
+                stack.extend((child, prefix+c) for c, child in node.children.items())
+            self._summaries[precision] = frozenset(areas)
+        return self._summaries[precision]
+
+
+def summary_covers(summary: Iterable[str], geohash: str) -> bool:
+    return any(geohash[:i] in summary for i in range(len(geohash)+1))
+
+
+def merge_summaries(own: Iterable[str], peer_summaries: Iterable[Dict[str, int]],
+                    radius: int = SUMMARY_RADIUS) -> Dict[str, int]:
+    """Areas a node advertises, each with the hops to its nearest subscriber: its own areas at 0 and
+    the areas its peers advertised one hop further, dropped once they are `radius` hops away."""
+    areas = {area: 0 for area in own}
+    for summary in peer_summaries:
+        for area, hops in summary.items():
+            if hops+1 < radius and hops+1 < areas.get(area, radius):
+                areas[area] = hops+1
+    return areas
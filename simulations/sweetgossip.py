@@ -1,46 +1,71 @@
 from __future__ import annotations
-from copy import deepcopy
+from copy import copy
 
 from datetime import datetime, timedelta
+from timeit import default_timer as timer
 from typing import Callable, Dict, List, Set, Tuple
 from uuid import UUID, uuid4
 
 import crypto
-from cert import Certificate
+from canonical import CanonicalObject
+from cert import Certificate, remember_verified_certificate
+from expiring import ExpiringDict
 from mass import Agent
 from myrepr import ReprObject
 from payments import HodlInvoice, Invoice, PaymentChannel, compute_payment_hash
+from peer_selection import FloodStrategy, PeerSelectionStrategy
 from pow import ProofOfWork, WorkRequest, pow_target_from_complexity
+from settlement import SettlementStore, get_settlement_store
+from subscriptions import SubscriptionIndex, merge_summaries
 
 from numpy import argmin
 
+# a router's invoice expires this much after the invoice it pays on, so that once the downstream
+# invoice is settled there is still time to settle its own
+INVOICE_EXPIRY_DELTA = timedelta(minutes=10)
+
+
+class SignableObject(CanonicalObject):
+    _canonical_exclude = ("signature",)
 
-class SignableObject(ReprObject):
     def sign(self, private_key: bytes) -> None:
-        self.signature = None
         self.signature = crypto.sign_object(self, private_key)
 
     def verify(self, public_key: bytes) -> bool:
-        signature = self.signature
-        self.signature = None
-        result = crypto.verify_object(self, signature, public_key)
-        self.signature = signature
-        return result
+        return crypto.verify_object(self, self.signature, public_key)
+
+    def verification_item(self, public_key: bytes) -> Tuple[SignableObject, bytes, bytes]:
+        return self, self.signature, public_key
 
 
-class OnionLayer(ReprObject):
+def verify_all_items(items: List) -> bool:
+    # items are (obj, signature, public_key) tuples or lists of them, None fails verification
+    if any(item is None for item in items):
+        return False
+    items = [i for item in items for i in (item if isinstance(item, list) else [item])]
+    if not all(crypto.verify_many(items)):
+        return False
+    # like Certificate.verify, the certificates are remembered only once the whole chain passed
+    for obj, _, public_key in items:
+        if isinstance(obj, Certificate):
+            remember_verified_certificate(obj, public_key)
+    return True
+
+
+class OnionLayer(CanonicalObject):
     def __init__(self, peer_name: str) -> None:
         self.peer_name = peer_name
 
 
-class OnionRoute(ReprObject):
+class OnionRoute(CanonicalObject):
     def __init__(self) -> None:
         self._onion = b""
 
-    def peel(self, priv_key: bytes) -> OnionLayer:
+    def peel(self, priv_key: bytes) -> Tuple[OnionLayer, OnionRoute]:
         layer, rest = crypto.decrypt_object(self._onion, priv_key)
-        self._onion = rest
-        return layer
+        rest_onion = OnionRoute()
+        rest_onion._onion = rest
+        return layer, rest_onion
 
     def grow(self, layer: OnionLayer, pub_key: bytes) -> OnionRoute:
         new_onion = OnionRoute()
@@ -51,7 +76,7 @@ class OnionRoute(ReprObject):
         return len(self._onion) == 0
 
 
-class AbstractTopic(ReprObject):
+class AbstractTopic(CanonicalObject):
     pass
 
 
@@ -62,13 +87,34 @@ class RequestPayload(SignableObject):
         self.sender_certificate = sender_certificate
 
 
-class AskForBroadcastFrame(ReprObject):
+class Frame(ReprObject):
+    """Protocol message; its fields are assigned once, in the constructor.
+
+    Frames are shared rather than copied between hops (deepcopy returns the frame itself), a
+    hop that has to change a field sends `replace(...)`, a shallow copy sharing the rest.
+    """
+
+    def __setattr__(self, name, value) -> None:
+        if name in vars(self):
+            raise AttributeError(f"{self.__class__.__name__}.{name} is immutable, use replace()")
+        object.__setattr__(self, name, value)
+
+    def __deepcopy__(self, memo) -> Frame:
+        return self
+
+    def replace(self, **changes) -> Frame:
+        frame = copy(self)
+        vars(frame).update(changes)
+        return frame
+
+
+class AskForBroadcastFrame(Frame):
     def __init__(self, signed_request_payload: RequestPayload) -> None:
         self.ask_id = uuid4()
         self.signed_request_payload = signed_request_payload
 
 
-class POWBroadcastConditionsFrame(ReprObject):
+class POWBroadcastConditionsFrame(Frame):
     def __init__(self, ask_id: UUID, valid_till: datetime, work_request: WorkRequest, timestamp_tolerance: timedelta) -> None:
         self.ask_id = ask_id
         self.valid_till = valid_till
@@ -76,7 +122,7 @@ class POWBroadcastConditionsFrame(ReprObject):
         self.timestamp_tolerance = timestamp_tolerance
 
 
-class BroadcastPayload(ReprObject):
+class BroadcastPayload(CanonicalObject):
     def __init__(self,
                  signed_request_payload: RequestPayload,
                  backward_onion: OnionRoute
@@ -89,7 +135,7 @@ class BroadcastPayload(ReprObject):
         self.timestamp = timestamp
 
 
-class POWBroadcastFrame(ReprObject):
+class POWBroadcastFrame(Frame):
     def __init__(self,
                  ask_id: UUID,
                  broadcast_payload: BroadcastPayload,
@@ -100,10 +146,10 @@ class POWBroadcastFrame(ReprObject):
         self.proof_of_work = proof_of_work
 
     def verify(self) -> bool:
-        if not self.broadcast_payload.signed_request_payload.sender_certificate.verify():
-            return False
-
-        if not self.broadcast_payload.signed_request_payload.verify(self.broadcast_payload.signed_request_payload.sender_certificate.public_key):
+        signed_request_payload = self.broadcast_payload.signed_request_payload
+        if not verify_all_items([
+                signed_request_payload.sender_certificate.verification_items(),
+                signed_request_payload.verification_item(signed_request_payload.sender_certificate.public_key)]):
             return False
 
         return self.proof_of_work.validate(self.broadcast_payload)
@@ -122,16 +168,14 @@ class SettlementPromise(SignableObject):
         self.reply_payment_amount = reply_payment_amount
 
     def verify_all(self, encrypted_signed_reply_payload: bytes) -> bool:
-        if not self.settler_certificate.verify():
-            return False
-        if not self.verify(self.settler_certificate.public_key):
-            return False
         if crypto.compute_sha256([encrypted_signed_reply_payload]) != self.hash_of_encrypted_reply_payload:
             return False
-        return True
+        return verify_all_items([
+            self.settler_certificate.verification_items(),
+            self.verification_item(self.settler_certificate.public_key)])
 
 
-class ReplyPayload(ReprObject):
+class ReplyPayload(CanonicalObject):
     def __init__(self,
                  replier_certificate: Certificate,
                  signed_request_payload: RequestPayload,
@@ -144,16 +188,13 @@ class ReplyPayload(ReprObject):
         self.reply_invoice = reply_invoice
 
     def verify_all(self):
-        if not self.replier_certificate.verify():
-            return False
-        if not self.signed_request_payload.sender_certificate.verify():
-            return False
-        if not self.signed_request_payload.verify(self.signed_request_payload.sender_certificate.public_key):
-            return False
-        return True
+        return verify_all_items([
+            self.replier_certificate.verification_items(),
+            self.signed_request_payload.sender_certificate.verification_items(),
+            self.signed_request_payload.verification_item(self.signed_request_payload.sender_certificate.public_key)])
 
 
-class ReplyFrame(ReprObject):
+class ReplyFrame(Frame):
     def __init__(self,
                  encrypted_reply_payload: bytes,
                  signed_settlement_promise: SettlementPromise,
@@ -176,18 +217,31 @@ class ReplyFrame(ReprObject):
         return reply_payload
 
 
-InvoiceById: Dict[UUID, Tuple[PaymentChannel, bytes]] = dict()
+def SetSettementCommand(settlement_store: SettlementStore, payment_channel: PaymentChannel, invoice_id: UUID, preimage,
+                        valid_till: datetime = None) -> None:
+    settlement_store.put(invoice_id, payment_channel, preimage, valid_till)
 
 
-def SetSettementCommand(payment_channel: PaymentChannel, invoice_id: UUID, preimage) -> None:
-    global InvoiceById
-    InvoiceById[invoice_id] = (payment_channel, preimage)
+def OnSettementCommand(settlement_store: SettlementStore, invoice: HodlInvoice) -> None:
+    entry = settlement_store.get(invoice.id)
+    if entry is None:
+        return
+    payment_channel, preimage = entry
+    payment_channel.settle_hodl_invoice(invoice, preimage)
+    if invoice.is_settled:
+        settlement_store.remove(invoice.id)
 
 
-def OnSettementCommand(invoice: HodlInvoice) -> None:
-    global InvoiceById
-    payment_channel,  preimage = InvoiceById[invoice.id]
-    payment_channel.settle_hodl_invoice(invoice, preimage)
+class SettlementCommand(ReprObject):
+    # on_accepted of a reply invoice; refers to the settlement store by id so that copies of the
+    # invoice that travelled pickled inside a reply can still be paid
+    def __init__(self, settlement_store_id: UUID) -> None:
+        self.settlement_store_id = settlement_store_id
+
+    def __call__(self, invoice: HodlInvoice) -> None:
+        settlement_store = get_settlement_store(self.settlement_store_id)
+        if settlement_store is not None:
+            OnSettementCommand(settlement_store, invoice)
 
 
 class Settler:
@@ -197,21 +251,25 @@ class Settler:
                  settler_private_key: bytes,
                  payment_channel: PaymentChannel,
                  price_amount_for_settlement: int,
+                 settlement_store_path: str = None,
                  ) -> None:
         self.settler_certificate = settler_certificate
         self._settler_private_key = settler_private_key
         self.payment_channel = payment_channel
         self.price_amount_for_settlement = price_amount_for_settlement
+        # preimages of the reply invoices, kept in `settlement_store_path` when given so they survive a restart
+        self.settlement_store = SettlementStore(settlement_store_path, payment_channel)
 
-    def generate_reply_payment_trust(self) -> Tuple[bytes, Callable[[HodlInvoice]]]:
+    def generate_reply_payment_trust(self, valid_till: datetime = None) -> Tuple[bytes, Callable[[HodlInvoice]]]:
         reply_preimage = crypto.generate_symmetric_key()
         reply_payment_hash = compute_payment_hash(reply_preimage)
 
         invoice_id = uuid4()
-        SetSettementCommand(self.payment_channel, invoice_id, reply_preimage)
-        return invoice_id, reply_payment_hash, OnSettementCommand
+        SetSettementCommand(self.settlement_store, self.payment_channel, invoice_id, reply_preimage, valid_till)
+        return invoice_id, reply_payment_hash, SettlementCommand(self.settlement_store.id)
 
-    def generate_settlement_trust(self, message: bytes, reply_invoice: HodlInvoice, signed_request_payload: RequestPayload, replier_certificate: Certificate) -> Tuple[HodlInvoice, SettlementPromise, bytes]:
+    def generate_settlement_trust(self, message: bytes, reply_invoice: HodlInvoice, signed_request_payload: RequestPayload, replier_certificate: Certificate,
+                                  valid_till: datetime = datetime.max) -> Tuple[HodlInvoice, SettlementPromise, bytes]:
 
         network_preimage = crypto.generate_symmetric_key()
         network_payment_hash = compute_payment_hash(network_preimage)
@@ -229,7 +287,8 @@ class Settler:
         network_invoice = self.payment_channel.create_hodl_invoice(
             self.price_amount_for_settlement,
             network_payment_hash,
-            on_accepted=on_accepted
+            on_accepted=on_accepted,
+            valid_till=valid_till
         )
 
         reply_payload = ReplyPayload(replier_certificate,
@@ -261,6 +320,8 @@ class SweetGossipNode(Agent):
                  timestamp_tolerance: timedelta,
                  invoice_payment_timeout: timedelta,
                  settler: Settler,
+                 peer_selection: PeerSelectionStrategy = None,
+                 invoice_expiry_delta: timedelta = INVOICE_EXPIRY_DELTA,
                  ):
         super().__init__(name)
         self.name = name
@@ -274,16 +335,29 @@ class SweetGossipNode(Agent):
         self.timestamp_tolerance = timestamp_tolerance
         self.invoice_payment_timeout = invoice_payment_timeout
         self.settler = settler
+        self.peer_selection = FloodStrategy() if peer_selection is None else peer_selection
+        self.invoice_expiry_delta = invoice_expiry_delta
+        self.subscriptions = SubscriptionIndex()
+        self.messages_sent = 0
+        # areas each peer advertised with the hops from that peer to their nearest subscriber
+        self._peer_subscription_summaries: Dict[str, Dict[str, int]] = dict()
 
         self._known_hosts: Dict[str, SweetGossipNode] = dict()
-        self._broadcast_payloads_by_ask_id: Dict[UUID, BroadcastPayload] = dict(
-        )
+        # per broadcast state is only useful while its broadcast conditions or reply invoices are
+        self._pending_broadcasts_by_ask_id: Dict[UUID, Tuple[RequestPayload, OnionRoute, str]] = ExpiringDict(
+            broadcast_conditions_timeout)
         self._my_pow_br_cond_by_ask_id: Dict[UUID,
-                                             POWBroadcastConditionsFrame] = dict()
-        self._already_broadcasted_request_payload_ids: Dict[UUID, int] = dict()
+                                             POWBroadcastConditionsFrame] = ExpiringDict(broadcast_conditions_timeout)
+        self._already_broadcasted_request_payload_ids: Dict[UUID, int] = ExpiringDict(
+            broadcast_conditions_timeout)
         self.reply_payloads: Dict[UUID,
                                   Dict[bytes,
-                                       List[Tuple[ReplyPayload, HodlInvoice]]]] = dict()
+                                       List[Tuple[ReplyPayload, HodlInvoice]]]] = ExpiringDict(invoice_payment_timeout)
+        self.first_reply_at: Dict[UUID, float] = ExpiringDict(invoice_payment_timeout)
+
+    def new_message(self, env, target, data):
+        self.messages_sent += 1
+        super().new_message(env, target, data)
 
     def connect_to(self, other):
         if other.name == self.name:
@@ -291,6 +365,36 @@ class SweetGossipNode(Agent):
         self._known_hosts[other.name] = other
         other._known_hosts[self.name] = self
 
+    def upstream_valid_till(self, downstream_valid_till: datetime) -> datetime:
+        # the invoice offered upstream has to outlive the one paid downstream, like HTLC expiry deltas
+        if downstream_valid_till > datetime.max-self.invoice_expiry_delta:
+            return datetime.max
+        return downstream_valid_till+self.invoice_expiry_delta
+
+    def degree(self) -> int:
+        return len(self._known_hosts)
+
+    def subscription_summary(self, for_peer: str = None) -> Dict[str, int]:
+        # what the peer advertised is not sent back to it
+        return merge_summaries(self.subscriptions.summary(),
+                               [summary for peer_name, summary in self._peer_subscription_summaries.items()
+                                if peer_name != for_peer])
+
+    def peer_subscription_summary(self, peer_name: str) -> Dict[str, int]:
+        return self._peer_subscription_summaries.get(peer_name, dict())
+
+    def on_subscription_summary(self, peer_name: str, summary: Dict[str, int]) -> bool:
+        if self._peer_subscription_summaries.get(peer_name) == summary:
+            return False
+        self._peer_subscription_summaries[peer_name] = summary
+        return True
+
+    def advertise_subscriptions(self) -> bool:
+        changed = False
+        for peer in self._known_hosts.values():
+            changed |= peer.on_subscription_summary(self.name, self.subscription_summary(peer.name))
+        return changed
+
     def accept_topic(self, topic: AbstractTopic) -> bool:
         return False
 
@@ -317,15 +421,13 @@ class SweetGossipNode(Agent):
             self.info(e, "already broadcasted")
             return
 
-        for peer in self._known_hosts.values():
-            if peer.name == originator_peer_name:
-                continue
+        peers = [peer for peer in self._known_hosts.values() if peer.name != originator_peer_name]
+        for peer in self.peer_selection.select(self, request_payload, peers):
             print(self.name, "================>>>>>>>>>", peer.name)
             ask_for_broadcast_frame = AskForBroadcastFrame(request_payload)
-            broadcast_payload = BroadcastPayload(request_payload,
-                                                 backward_onion.grow(OnionLayer(
-                                                     self.name), peer.certificate.public_key))
-            self._broadcast_payloads_by_ask_id[ask_for_broadcast_frame.ask_id] = broadcast_payload
+            # the onion layer for the peer is only encrypted once it sends its broadcast conditions
+            self._pending_broadcasts_by_ask_id[ask_for_broadcast_frame.ask_id] = (
+                request_payload, backward_onion, peer.name)
             self.new_message(e, peer, ask_for_broadcast_frame)
 
     def on_ask_for_broadcast_frame(self, e, m, peer: SweetGossipNode, ask_for_broadcast_frame: AskForBroadcastFrame):
@@ -344,12 +446,22 @@ class SweetGossipNode(Agent):
 
     def on_pow_broadcast_conditions_frame(self, e, m, peer: SweetGossipNode, pow_broadcast_condtitions_frame: POWBroadcastConditionsFrame):
         if datetime.now() <= pow_broadcast_condtitions_frame.valid_till:
-            if pow_broadcast_condtitions_frame.ask_id in self._broadcast_payloads_by_ask_id:
-                broadcast_payload = self._broadcast_payloads_by_ask_id[
+            if pow_broadcast_condtitions_frame.ask_id in self._pending_broadcasts_by_ask_id:
+                request_payload, backward_onion, peer_name = self._pending_broadcasts_by_ask_id[
                     pow_broadcast_condtitions_frame.ask_id]
+                if peer_name != peer.name:
+                    return
+                # each ask is answered once, the payload is shared with the peer once sent
+                del self._pending_broadcasts_by_ask_id[pow_broadcast_condtitions_frame.ask_id]
+                broadcast_payload = BroadcastPayload(request_payload,
+                                                     backward_onion.grow(OnionLayer(
+                                                         self.name), peer.certificate.public_key))
                 broadcast_payload.set_timestamp(datetime.now())
                 pow = pow_broadcast_condtitions_frame.work_request.compute_proof(
-                    broadcast_payload)
+                    broadcast_payload, deadline=pow_broadcast_condtitions_frame.valid_till)
+                if pow.nuance is None:
+                    self.info(e, "proof of work not found before broadcast conditions expired")
+                    return
                 pow_broadcast_frame = POWBroadcastFrame(pow_broadcast_condtitions_frame.ask_id,
                                                         broadcast_payload,
                                                         pow)
@@ -386,16 +498,18 @@ class SweetGossipNode(Agent):
 
         if message is not None:
 
-            invoice_id, reply_payment_hash, on_accepted = self.settler.generate_reply_payment_trust()
+            valid_till = datetime.now()+self.invoice_payment_timeout
+            invoice_id, reply_payment_hash, on_accepted = self.settler.generate_reply_payment_trust(valid_till)
 
             reply_invoice = self.payment_channel.create_hodl_invoice(
-                fee, reply_payment_hash, on_accepted, invoice_id=invoice_id)
+                fee, reply_payment_hash, on_accepted, valid_till=valid_till, invoice_id=invoice_id)
 
             signed_settlement_promise, network_invoice, encrypted_reply_payload = self.settler.generate_settlement_trust(
                 message=message,
                 reply_invoice=reply_invoice,
                 signed_request_payload=pow_broadcast_frame.broadcast_payload.signed_request_payload,
-                replier_certificate=self.certificate)
+                replier_certificate=self.certificate,
+                valid_till=valid_till)
 
             response_frame = ReplyFrame(
                 encrypted_reply_payload=encrypted_reply_payload,
@@ -432,16 +546,18 @@ class SweetGossipNode(Agent):
 
             self.reply_payloads[payload_id][replier_id].append(
                 (reply_payload, response_frame.network_invoice))
+            if payload_id not in self.first_reply_at:
+                self.first_reply_at[payload_id] = timer()
             self.info(e, "reply payload frame collected")
         else:
-            top_layer = response_frame.forward_onion.peel(
+            top_layer, forward_onion = response_frame.forward_onion.peel(
                 self._private_key)
             if top_layer.peer_name in self._known_hosts:
                 if not response_frame.signed_settlement_promise.verify_all(response_frame.encrypted_reply_payload):
                     return
                 if response_frame.signed_settlement_promise.network_payment_hash != response_frame.network_invoice.payment_hash:
                     return
-                network_invoice = None
+                response_frame = response_frame.replace(forward_onion=forward_onion)
                 if not new_response:
                     next_network_invoice = response_frame.network_invoice
 
@@ -458,10 +574,11 @@ class SweetGossipNode(Agent):
                         response_frame.network_invoice.amount+self.price_amount_for_routing,
                         response_frame.network_invoice.payment_hash,
                         on_accepted,
+                        valid_till=self.upstream_valid_till(response_frame.network_invoice.valid_till),
+                        routing_fee=self.price_amount_for_routing,
                     )
 
-                    response_frame = deepcopy(response_frame)
-                    response_frame.network_invoice = network_invoice
+                    response_frame = response_frame.replace(network_invoice=network_invoice)
                 self.new_message(
                     e, self._known_hosts[top_layer.peer_name], response_frame)
 
@@ -504,3 +621,11 @@ class SweetGossipNode(Agent):
             self.on_response_frame(e, m, m.sender, m.data)
         else:
             self.trace(e, "unknown request:", m)
+
+
+def propagate_subscription_summaries(nodes: List[SweetGossipNode]) -> int:
+    # advertising rounds until no summary changes
+    rounds = 1
+    while any([node.advertise_subscriptions() for node in nodes]):
+        rounds += 1
+    return rounds